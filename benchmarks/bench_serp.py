@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Search result page parser benchmarks
+
+Runs the search spiders' parsers over the saved result pages in
+fixtures/serp/, checks what they extract against the expected results
+saved next to them (<page>.json), and times them per page: from the
+raw HTML ('page'), and with the document already parsed ('extract').
+
+Parser changes should keep the expected results (or come with updated
+ones, see --save) and compare their numbers to those before.
+
+Usage:
+    bench_serp.py [options]
+
+Options:
+    --repeat=<n>        best-of repetitions [default: 5]
+    --rounds=<n>        times each page is parsed per repetition [default: 20]
+    --fixtures=<dir>    saved result pages (default: fixtures/serp next to this script)
+    --page=<name>       only this page (e.g. bing_more)
+    --save              write the expected results from the current parsers
+    --json              print one machine-readable JSON document
+    -h --help           show this help
+"""
+from __future__ import absolute_import, unicode_literals, print_function, division
+import sys, os
+import io
+import gc
+import json
+import logging
+import platform
+from timeit import default_timer
+from docopt import docopt
+
+# (before importing the bot, which may leave the working directory elsewhere)
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from scrapy.http import HtmlResponse, Request
+from reddit_info_bot.spiders import search as search_spiders
+
+from bench_spamfilter import commit, peak_memory
+
+# page -> (spider, callback, url it was retrieved from, request meta)
+PAGES = {
+    'karmadecay': ('KarmaDecay', 'parse', 'http://karmadecay.com/index/', {}),
+    'yandex': ('Yandex', 'parse', 'https://www.yandex.com/images/search?rpt=imageview', {}),
+    'bing': ('Bing', 'parse', 'https://www.bing.com/images/searchbyimage?cbir=sbi', {}),
+    'bing_image': ('Bing', 'parse_image', 'https://www.bing.com/images/search?view=detailv2',
+                   {'more': 'https://www.bing.com/images/search?q=imgurl&view=more'}),
+    'bing_more': ('Bing', 'parse_more', 'https://www.bing.com/images/search?q=imgurl&view=more', {}),
+    'tineye': ('Tineye', 'parse', 'https://www.tineye.com/search/abc?page=2', {}),
+    'google': ('Google', 'parse', 'https://www.google.com/search?tbs=sbi', {}),
+}
+
+
+def bench_spider(name):
+    """The `name` search spider, with results passed on as they are"""
+    base = getattr(search_spiders, name)
+
+    class BenchSpider(base):
+        def parse_result(self, result):
+            return result
+        def classify_results(self, results, fields=None):
+            return len(results)
+        def search_failed(self, kind, message):
+            self.failed.append(kind)
+
+    BenchSpider.__name__ = str(name) # (the results' provider)
+    spider = BenchSpider(image_url='http://example.com/image.jpg', num_results=1000)
+    spider.failed = []
+    return spider
+
+def response_for(page, body):
+    _, _, url, meta = PAGES[page]
+    request = Request(url, meta=dict(meta))
+    return HtmlResponse(url, body=body, encoding='utf-8', request=request)
+
+def extract(spider, callback, response):
+    """What the spider's `callback` gets from `response`, as plain data"""
+    output = []
+    for obj in getattr(spider, callback)(response) or ():
+        if isinstance(obj, Request):
+            output.append({'request': obj.url, 'callback': getattr(obj.callback, '__name__', None),
+                           'result': obj.meta.get('result')})
+        elif obj is not None:
+            output.append(dict(obj))
+    if spider.failed:
+        output.append({'failed': spider.failed})
+    return json.loads(json.dumps(output, sort_keys=True))
+
+def measure(name, func, rounds, repeat):
+    """Best-of-`repeat` time of `rounds` calls of `func`"""
+    best = None
+    for run in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = default_timer()
+            for _ in range(rounds):
+                func()
+            total = default_timer() - start
+        finally:
+            gc.enable()
+        if best is None or total < best:
+            best = total
+    return {
+        'name': name,
+        'count': rounds,
+        'ms_per_page': round(best / rounds * 1000, 4),
+        'per_second': round(rounds / best, 1) if best else None,
+        'peak_kib': peak_memory(),
+    }
+
+#
+# benchmark run
+#
+
+def run(opts):
+    fixtures = opts['--fixtures'] or os.path.join(HERE, 'fixtures', 'serp')
+    repeat = int(opts['--repeat'])
+    rounds = int(opts['--rounds'])
+    pages = [opts['--page']] if opts['--page'] else sorted(PAGES)
+
+    checks = {}
+    benchmarks = []
+    for page in pages:
+        name, callback, _, _ = PAGES[page]
+        with io.open(os.path.join(fixtures, '%s.html' % page), 'rb') as fh:
+            body = fh.read()
+
+        output = extract(bench_spider(name), callback, response_for(page, body))
+        expected_file = os.path.join(fixtures, '%s.json' % page)
+        if opts['--save']:
+            with io.open(expected_file, 'w', encoding='utf-8') as fh:
+                fh.write(json.dumps(output, indent=1, sort_keys=True, ensure_ascii=False))
+                fh.write('\n')
+            checks[page] = 'saved'
+        elif not os.path.exists(expected_file):
+            checks[page] = 'no expected results'
+        else:
+            with io.open(expected_file, 'r', encoding='utf-8') as fh:
+                expected = json.load(fh)
+            checks[page] = 'ok' if output == expected else 'MISMATCH'
+
+        spider = bench_spider(name)
+        def parse_page():
+            spider.failed = []
+            list(getattr(spider, callback)(response_for(page, body)) or ())
+        parsed = response_for(page, body)
+        parsed.selector # (parse the document once)
+        def parse_extract():
+            spider.failed = []
+            list(getattr(spider, callback)(parsed) or ())
+
+        results = sum(1 for obj in output if 'provider' in obj or 'result' in obj)
+        for stats in (measure('%s page' % page, parse_page, rounds, repeat),
+                      measure('%s extract' % page, parse_extract, rounds, repeat)):
+            stats.update(page=page, results=results, bytes=len(body))
+            benchmarks.append(stats)
+
+    return {
+        'version': commit(),
+        'python': platform.python_version(),
+        'options': dict((key.lstrip('-'), value) for key, value in opts.items()
+                        if key not in ('--help', '--json')),
+        'checks': checks,
+        'benchmarks': benchmarks,
+        'peak_kib': peak_memory(),
+    }
+
+def report(results):
+    print('SERP parser benchmark @ %s (python %s)' % (results['version'], results['python']))
+    print('')
+    print('%-22s %8s %8s %12s %10s %12s' % ('', 'results', 'KiB', 'ms/page', 'pages/s', 'check'))
+    for stats in results['benchmarks']:
+        print('%-22s %8d %8d %12.3f %10.1f %12s' % (
+            stats['name'], stats['results'], stats['bytes'] // 1024, stats['ms_per_page'],
+            stats['per_second'] or 0, results['checks'][stats['page']]))
+
+def main(argv=None):
+    opts = docopt(__doc__, argv)
+    logging.basicConfig(level=logging.WARNING)
+    results = run(opts)
+    if opts['--json']:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        report(results)
+    if 'MISMATCH' in results['checks'].values():
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
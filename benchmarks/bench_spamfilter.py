@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Spamfilter benchmarks
+
+Measures the spam-check hot path (list loading, domain_suffix, _check,
+isspam_link, isspam_text and the batch API) against synthetic lists
+of a given size, or against the real cached spamfilter_*.json files.
+The "cold cache" runs start each repetition on an empty verdict cache,
+as on a bot checking results it has not seen before.
+
+Runs are seeded, so two runs with the same options classify the same
+inputs; compare the --json output of two commits to spot regressions.
+
+Usage:
+    bench_spamfilter.py [options]
+
+Options:
+    --link-rules=<n>    synthetic link rules [default: 25000]
+    --text-rules=<n>    synthetic text/user rules [default: 3000]
+    --inputs=<n>        URLs and texts classified per benchmark [default: 20000]
+    --spam-ratio=<r>    share of inputs that should match a rule [default: 0.1]
+    --seed=<n>          random seed [default: 1]
+    --repeat=<n>        best-of repetitions [default: 3]
+    --cachedir=<dir>    use the cached spamfilter_*.json lists in <dir>
+    --psl=<file>        public suffix list (default: second-level fallback)
+    --urls=<file>       recorded result URLs to classify, one per line
+    --texts=<file>      recorded result titles to classify, one per line
+    --prefilter         enable the bloom prefilter
+    --json              print one machine-readable JSON document
+    -h --help           show this help
+"""
+from __future__ import absolute_import, unicode_literals, print_function, division
+import sys, os
+import io
+import gc
+import json
+import random
+import shutil
+import tempfile
+import platform
+import resource
+import subprocess
+from timeit import default_timer
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from reddit_info_bot import spamfilter, util
+from reddit_info_bot.cache import SqliteCache
+from reddit_info_bot.publicsuffix import PublicSuffixList
+from reddit_info_bot.spamfilter import (
+    FILTER_TYPES, _filter_filename, _load_dataset, _strip_scheme, _check,
+    compile_spamfilter_lists, save_compiled_lists, load_compiled_lists,
+    isspam_link, isspam_text, isspam_links, isspam_texts,
+)
+
+
+WORDS = ('free buy cheap best online shop deal sale pics hot new top video '
+         'gallery photo image wallpaper cute funny game app store news club '
+         'daily world blog share viral meme viewer tube host upload').split()
+TLDS = ('com', 'net', 'org', 'info', 'biz', 'ru', 'co.uk', 'de', 'io', 'xyz')
+SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'to', 'vi', 'ze', 'pu', 'da', 'go')
+
+
+def commit():
+    """The checked out commit, to tell results apart"""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def peak_memory():
+    """Peak resident set size of this process, in KiB"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # (bytes)
+        usage //= 1024
+    return usage
+
+#
+# corpora
+#
+
+def pseudo_word(rnd):
+    return ''.join(rnd.choice(SYLLABLES) for i in range(rnd.randint(2, 4)))
+
+def synthetic_host(rnd):
+    name = rnd.choice(WORDS) + pseudo_word(rnd) + str(rnd.randint(0, 999))
+    host = '{0}.{1}'.format(name, rnd.choice(TLDS))
+    if rnd.random() < 0.3:
+        host = rnd.choice(('www', 'i', 'img', 'm', 'cdn')) + '.' + host
+    return host
+
+def synthetic_path(rnd):
+    return '/'.join([''] + rnd.sample(WORDS, rnd.randint(0, 3)))
+
+def synthetic_filters(rnd, link_rules, text_rules):
+    """Spam lists shaped like the rarchives ones"""
+    filters = dict((filter_type, set()) for filter_type in FILTER_TYPES)
+    while len(filters['link']) < link_rules:
+        kind = rnd.random()
+        if kind < 0.6:
+            rule = synthetic_host(rnd) # whole domain
+        elif kind < 0.9:
+            rule = synthetic_host(rnd) + synthetic_path(rnd) # page
+        else:
+            rule = pseudo_word(rnd) + pseudo_word(rnd) # bare keyword
+        filters['link'].add(rule)
+    while len(filters['thumb']) < link_rules // 10:
+        filters['thumb'].add(synthetic_host(rnd) + '/thumbs/')
+    while len(filters['text']) < text_rules:
+        filters['text'].add(' '.join([rnd.choice(WORDS)] +
+                                     [pseudo_word(rnd) for i in range(rnd.randint(1, 2))]))
+    while len(filters['user']) < text_rules // 3:
+        filters['user'].add('{0}_{1}'.format(pseudo_word(rnd), rnd.randint(0, 99999)))
+    filters['tld'] = set(['.tk', '.ml', '.ga'])
+    return filters
+
+def cached_filters(cachedir):
+    """The real spam lists, as last synced into `cachedir`"""
+    filters = {}
+    for filter_type in FILTER_TYPES:
+        dataset = _load_dataset(_filter_filename(filter_type, cachedir), filter_type)
+        if dataset is None:
+            sys.exit('No usable cached %s filters in %s' % (filter_type, cachedir))
+        filters[filter_type] = set(val['spamtext'] for val in dataset['filters'])
+    return filters
+
+def synthetic_urls(rnd, filters, count, spam_ratio):
+    rules = sorted(filters['link'])
+    urls = []
+    for i in range(count):
+        if rules and rnd.random() < spam_ratio:
+            rule = rnd.choice(rules)
+            if '.' in rule.split('/')[0]:
+                url = 'http://' + rule.lstrip('/')
+            else:
+                url = 'http://{0}/{1}.html'.format(synthetic_host(rnd), rule)
+        else:
+            url = 'http://{0}{1}/{2}.jpg'.format(synthetic_host(rnd),
+                                                 synthetic_path(rnd), rnd.randint(0, 99999))
+        urls.append(url.lower())
+    return urls
+
+def synthetic_texts(rnd, filters, count, spam_ratio):
+    rules = sorted(filters['text'] | filters['user'])
+    texts = []
+    for i in range(count):
+        words = rnd.sample(WORDS, rnd.randint(3, 8))
+        if rules and rnd.random() < spam_ratio:
+            words.insert(rnd.randint(0, len(words)), rnd.choice(rules))
+        texts.append(' '.join(words).lower())
+    return texts
+
+def recorded(filename):
+    with io.open(filename, encoding='utf-8') as inf:
+        return [line.strip().lower() for line in inf if line.strip()]
+
+#
+# measurement
+#
+
+def measure(name, func, inputs, repeat, setup=None):
+    """Time `func` per input; best-of-`repeat` throughput, latencies of that run"""
+    best = None
+    for run in range(repeat):
+        if setup:
+            setup()
+        latencies = []
+        gc.collect()
+        gc.disable()
+        try:
+            start = default_timer()
+            for item in inputs:
+                t = default_timer()
+                func(item)
+                latencies.append(default_timer() - t)
+            total = default_timer() - start
+        finally:
+            gc.enable()
+        if best is None or total < best[0]:
+            best = (total, latencies)
+    total, latencies = best
+    return result(name, len(inputs), total, latencies)
+
+def measure_batch(name, func, inputs, repeat, size=50, setup=None):
+    """Time `func` over batches of `size` inputs (a SERP page)"""
+    batches = [inputs[i:i+size] for i in range(0, len(inputs), size)]
+    best = None
+    for run in range(repeat):
+        if setup:
+            setup()
+        latencies = []
+        gc.collect()
+        gc.disable()
+        try:
+            start = default_timer()
+            for batch in batches:
+                t = default_timer()
+                func(batch)
+                latencies.append((default_timer() - t) / len(batch))
+            total = default_timer() - start
+        finally:
+            gc.enable()
+        if best is None or total < best[0]:
+            best = (total, latencies)
+    total, latencies = best
+    return result(name, len(inputs), total, latencies)
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def result(name, count, total, latencies):
+    return {
+        'name': name,
+        'count': count,
+        'seconds': round(total, 6),
+        'per_second': round(count / total, 1) if total else None,
+        'p50_us': round(percentile(latencies, 50) * 1e6, 2),
+        'p99_us': round(percentile(latencies, 99) * 1e6, 2),
+        'peak_kib': peak_memory(),
+    }
+
+def cold_verdict_cache(tmpdir):
+    """A setup for measure(): a new, empty verdict cache in `tmpdir`"""
+    def setup():
+        spamfilter.flush_verdicts()
+        spamfilter.verdict_memo.clear()
+        spamfilter.verdict_cache = SqliteCache(
+            tempfile.mkdtemp(dir=tmpdir) + '/verdicts.sqlite', maxsize=1000000)
+    return setup
+
+def timed(name, func, *args):
+    start = default_timer()
+    value = func(*args)
+    total = default_timer() - start
+    return value, {'name': name, 'seconds': round(total, 6), 'peak_kib': peak_memory()}
+
+#
+# benchmark run
+#
+
+def run(opts):
+    rnd = random.Random(int(opts['--seed']))
+    repeat = int(opts['--repeat'])
+    count = int(opts['--inputs'])
+    spam_ratio = float(opts['--spam-ratio'])
+
+    if opts['--psl']:
+        with open(opts['--psl'], 'rb') as fh:
+            util.psl_cached = PublicSuffixList(fh)
+
+    loads = []
+    if opts['--cachedir']:
+        cachedir = opts['--cachedir'].rstrip('/') + '/'
+        filters, stats = timed('read json lists', cached_filters, cachedir)
+        loads.append(stats)
+        corpus = 'cached:' + cachedir
+    else:
+        filters = synthetic_filters(rnd, int(opts['--link-rules']), int(opts['--text-rules']))
+        corpus = 'synthetic'
+
+    lists, stats = timed('compile lists', compile_spamfilter_lists, filters,
+                         bool(opts['--prefilter']))
+    loads.append(stats)
+
+    # round trip through the compiled cache, as on a bot (re-)start
+    tmpdir = tempfile.mkdtemp(prefix='bench_spamfilter.') + '/'
+    try:
+        signature = [['bench', len(lists['link']), 0]]
+        _, stats = timed('save compiled cache', save_compiled_lists, tmpdir, signature, lists)
+        loads.append(stats)
+        lists, stats = timed('load compiled cache', load_compiled_lists, tmpdir, signature)
+        loads.append(stats)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    # the hot path only, no verdicts remembered between runs
+    spamfilter.LISTS = lists
+    spamfilter.verdict_cache = None
+    spamfilter.use_prefilter = bool(opts['--prefilter'])
+
+    urls = recorded(opts['--urls']) if opts['--urls'] else \
+        synthetic_urls(rnd, filters, count, spam_ratio)
+    texts = recorded(opts['--texts']) if opts['--texts'] else \
+        synthetic_texts(rnd, filters, count, spam_ratio)
+    stripped = [_strip_scheme(url) for url in urls]
+
+    benchmarks = [
+        measure('domain_suffix', util.domain_suffix, stripped, repeat),
+        measure('_check link', lambda url: _check(url, lists['link'], util.domain_suffix(url)[0]),
+                stripped, repeat),
+        measure('_check text', lambda text: _check(text, lists['text']), texts, repeat),
+        measure('isspam_link', isspam_link, urls, repeat),
+        measure('isspam_text', isspam_text, texts, repeat),
+        measure_batch('isspam_links (50/batch)', isspam_links, urls, repeat),
+        measure_batch('isspam_texts (50/batch)', isspam_texts, texts, repeat),
+    ]
+
+    tmpdir = tempfile.mkdtemp(prefix='bench_spamfilter.') + '/'
+    try:
+        benchmarks += [
+            measure('isspam_link (cold cache)', isspam_link, urls, repeat,
+                    setup=cold_verdict_cache(tmpdir)),
+            measure_batch('isspam_links (cold cache)', isspam_links, urls, repeat,
+                          setup=cold_verdict_cache(tmpdir)),
+            measure('isspam_text (cold cache)', isspam_text, texts, repeat,
+                    setup=cold_verdict_cache(tmpdir)),
+            measure_batch('isspam_texts (cold cache)', isspam_texts, texts, repeat,
+                          setup=cold_verdict_cache(tmpdir)),
+        ]
+    finally:
+        spamfilter.flush_verdicts()
+        spamfilter.verdict_cache = None
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return {
+        'version': commit(),
+        'python': platform.python_version(),
+        'options': dict((key.lstrip('-'), value) for key, value in opts.items()
+                        if key not in ('--help', '--json')),
+        'corpus': corpus,
+        'lists': dict((filter_type, len(filters[filter_type])) for filter_type in FILTER_TYPES),
+        'spam': {
+            'urls': sum(isspam_link(url) for url in urls),
+            'texts': sum(isspam_text(text) for text in texts),
+        },
+        'load': loads,
+        'benchmarks': benchmarks,
+        'psl': util.psl_cached.stats() if opts['--psl'] else None,
+        'peak_kib': peak_memory(),
+    }
+
+def report(results):
+    print('spamfilter benchmark @ %s (python %s)' % (results['version'], results['python']))
+    print('corpus: %s, lists: %s' % (results['corpus'], ', '.join(
+        '%s=%d' % (k, v) for k, v in sorted(results['lists'].items()))))
+    print('spam found: %(urls)d urls, %(texts)d texts' % results['spam'])
+    if results['psl']:
+        print('psl lookups: %(hits)d memoized, %(misses)d computed' % results['psl'])
+    print('')
+    for stats in results['load']:
+        print('%-26s %10.3f ms %12d KiB peak' % (
+            stats['name'], stats['seconds'] * 1000, stats['peak_kib']))
+    print('')
+    print('%-26s %12s %10s %10s %12s' % ('', 'ops/s', 'p50 us', 'p99 us', 'KiB peak'))
+    for stats in results['benchmarks']:
+        print('%-26s %12.1f %10.2f %10.2f %12d' % (
+            stats['name'], stats['per_second'] or 0, stats['p50_us'],
+            stats['p99_us'], stats['peak_kib']))
+
+def main(argv=None):
+    opts = docopt(__doc__, argv)
+    results = run(opts)
+    if opts['--json']:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        report(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Aho-Corasick multi-pattern string matching
+
+Finds all patterns out of a (large) fixed set which occur
+inside a string, in a single pass over that string.
+"""
+from __future__ import absolute_import, unicode_literals
+from collections import deque
+
+
+class Automaton(object):
+    """Compiled matcher over a set of patterns.
+
+    Iterating an Automaton yields the patterns it was built from,
+    in their original order, so it can stand in for that collection.
+    """
+
+    def __init__(self, patterns=()):
+        self.patterns = tuple(patterns)
+        self._build()
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _build(self):
+        # flat node tables (node 0 is the root), no recursion
+        goto = [{}] # node -> {char: child node}
+        fail = [0]  # node -> longest proper suffix node
+        out = [()]  # node -> indexes of patterns ending here
+
+        for index, pattern in enumerate(self.patterns):
+            node = 0
+            for char in pattern:
+                child = goto[node].get(char)
+                if child is None:
+                    child = len(goto)
+                    goto[node][char] = child
+                    goto.append({})
+                    fail.append(0)
+                    out.append(())
+                node = child
+            out[node] += (index,)
+
+        # breadth-first, so failure targets are always done first
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(char, 0)
+                out[child] += out[fail[child]]
+
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+
+    def findall(self, string):
+        """Return all patterns found in `string`
+
+        (in pattern order, each pattern only once).
+        """
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set(out[0]) # the empty pattern is in everything
+        node = 0
+        for char in string:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                found.update(out[node])
+        return [self.patterns[index] for index in sorted(found)]
+
+    def indexes_each(self, strings):
+        """Return the indexes of the patterns found in each of `strings`
+
+        (sorted, for every string in turn, without a findall() call each).
+        """
+        goto, fail, out = self._goto, self._fail, self._out
+        results = []
+        for string in strings:
+            found = set(out[0])
+            node = 0
+            for char in string:
+                while node and char not in goto[node]:
+                    node = fail[node]
+                node = goto[node].get(char, 0)
+                if out[node]:
+                    found.update(out[node])
+            results.append(sorted(found))
+        return results
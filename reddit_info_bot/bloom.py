@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Bloom filters
+
+Compact, probabilistic set membership: a lookup may report
+false positives (at a configurable rate), but never false negatives.
+All bits live in a single bytearray.
+"""
+from __future__ import absolute_import, unicode_literals
+import math
+import zlib
+import six
+
+
+def _to_bytes(string):
+    if isinstance(string, six.text_type):
+        return string.encode('utf-8')
+    return string
+
+
+class BloomFilter(object):
+    """Bloom filter over byte strings"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        nbits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nbits = max(nbits, 8)
+        self.nhashes = max(1, int(round(self.nbits / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.nbits + 7) // 8)
+
+    def _hashes(self, key):
+        # double hashing, both derived from one crc32
+        h1 = zlib.crc32(key) & 0xffffffff
+        h2 = (((h1 >> 16) | (h1 << 16)) & 0xffffffff) | 1
+        return h1, h2
+
+    def add(self, key):
+        h1, h2 = self._hashes(key)
+        bits, nbits = self.bits, self.nbits
+        for i in range(self.nhashes):
+            pos = (h1 + i * h2) % nbits
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        h1, h2 = self._hashes(key)
+        bits, nbits = self.bits, self.nbits
+        for i in range(self.nhashes):
+            pos = (h1 + i * h2) % nbits
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class SubstringPrefilter(object):
+    """Probabilistic test whether any of `patterns` may occur in a string
+
+    Every occurrence of a pattern starts with that pattern's first
+    `q` bytes, so those are kept in a Bloom filter and every `q`-byte
+    window of a string is looked up. Patterns shorter than that are
+    tested directly.
+    """
+
+    q = 4
+
+    def __init__(self, patterns, error_rate=0.0001):
+        # (low error rate, a string is tested once per byte)
+        short = set()
+        grams = set()
+        for pattern in patterns:
+            pattern = _to_bytes(pattern)
+            if len(pattern) < self.q:
+                short.add(pattern)
+            else:
+                grams.add(pattern[:self.q])
+        self.short = tuple(short)
+        self.bloom = BloomFilter(len(grams), error_rate)
+        for gram in grams:
+            self.bloom.add(gram)
+
+    def may_match(self, string):
+        data = _to_bytes(string)
+        for pattern in self.short:
+            if pattern in data:
+                return True
+        bloom, q = self.bloom, self.q
+        for i in range(len(data) - q + 1):
+            if data[i:i+q] in bloom:
+                return True
+        return False
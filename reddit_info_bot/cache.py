@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent caches
+
+Small key-value stores kept in the cache directory,
+which the bot and its forked search processes can share.
+"""
+from __future__ import absolute_import, unicode_literals
+import os
+import time
+import logging
+import sqlite3
+import threading
+from six.moves import cPickle as pickle
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteCache(object):
+    """Size-bounded key-value store in an sqlite database file
+
+    Values are pickled. Every entry carries a `tag` (e.g. the version
+    of the data it was derived from); lookups for a different tag miss.
+    Connections are opened per process and thread, so an instance can
+    be used on both sides of a fork and from background threads.
+    Database errors are logged and treated as cache misses,
+    a cache never breaks its caller.
+    """
+
+    prune_interval = 100 # check size every N writes
+
+    def __init__(self, filename, maxsize=10000, timeout=10):
+        self.filename = filename
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._conns = {} # thread -> connection
+        self._pid = None
+        self._inherited = []
+        self._writes = 0
+
+    def _connection(self):
+        pid, thread = os.getpid(), threading.current_thread().ident
+        if self._pid != pid:
+            # opened before a fork, must not be used (or closed) here
+            self._inherited.extend(self._conns.values())
+            self._conns, self._pid = {}, pid
+        conn = self._conns.get(thread)
+        if conn is not None:
+            return conn
+        conn = sqlite3.connect(self.filename, timeout=self.timeout,
+                               isolation_level=None) # autocommit
+        conn.execute('PRAGMA journal_mode=WAL')
+        # (no fsync per commit, a power loss may only lose the last entries)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                     'key TEXT PRIMARY KEY, tag TEXT, value BLOB, created REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS cache_created ON cache (created)')
+        self._conns[thread] = conn
+        return conn
+
+    def get(self, key, tag=None, maxage=None):
+        """Return the value cached for `key` (None if there is none)"""
+        try:
+            row = self._connection().execute(
+                'SELECT tag, value, created FROM cache WHERE key = ?',
+                (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('%s: lookup failed: %s' % (self.filename, e))
+            return None
+        if not row:
+            return None
+        _tag, value, created = row
+        if _tag != tag:
+            return None
+        if maxage is not None and time.time() - created > maxage:
+            return None
+        return pickle.loads(bytes(value))
+
+    def get_many(self, keys, tag=None, maxage=None):
+        """Return the values cached for `keys`, by key (misses left out)"""
+        keys = list(keys)
+        found = {}
+        try:
+            conn = self._connection()
+            for i in range(0, len(keys), 500): # (sqlite's variable limit)
+                chunk = keys[i:i+500]
+                found.update((key, (_tag, value, created)) for key, _tag, value, created in conn.execute(
+                    'SELECT key, tag, value, created FROM cache WHERE key IN (%s)'
+                    % ','.join('?' * len(chunk)), chunk))
+        except sqlite3.Error as e:
+            logger.warning('%s: lookup failed: %s' % (self.filename, e))
+            return {}
+        now = time.time()
+        return dict((key, pickle.loads(bytes(value)))
+                    for key, (_tag, value, created) in found.items()
+                    if _tag == tag and (maxage is None or now - created <= maxage))
+
+    def set_many(self, items, tag=None):
+        """Cache all `items` (key, value pairs) in one transaction"""
+        now = time.time()
+        rows = [(key, tag, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), now)
+                for key, value in items]
+        if not rows:
+            return
+        try:
+            conn = self._connection()
+            conn.execute('BEGIN')
+            try:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO cache (key, tag, value, created) VALUES (?, ?, ?, ?)',
+                    rows)
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            before, self._writes = self._writes, self._writes + len(rows)
+            if self._writes // self.prune_interval != before // self.prune_interval:
+                self.prune()
+        except sqlite3.Error as e:
+            logger.warning('%s: write failed: %s' % (self.filename, e))
+
+    def set(self, key, value, tag=None):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        try:
+            conn = self._connection()
+            conn.execute(
+                'INSERT OR REPLACE INTO cache (key, tag, value, created) VALUES (?, ?, ?, ?)',
+                (key, tag, sqlite3.Binary(value), time.time()))
+            self._writes += 1
+            if self._writes % self.prune_interval == 0:
+                self.prune()
+        except sqlite3.Error as e:
+            logger.warning('%s: write failed: %s' % (self.filename, e))
+
+    def delete(self, key):
+        try:
+            self._connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            logger.warning('%s: write failed: %s' % (self.filename, e))
+
+    def invalidate(self, tag=None):
+        """Drop all entries not tagged `tag`"""
+        try:
+            self._connection().execute(
+                'DELETE FROM cache WHERE tag IS NOT ?', (tag,))
+        except sqlite3.Error as e:
+            logger.warning('%s: write failed: %s' % (self.filename, e))
+
+    def prune(self):
+        """Drop the oldest entries above `maxsize`"""
+        if not self.maxsize:
+            return
+        self._connection().execute(
+            'DELETE FROM cache WHERE key IN ('
+            'SELECT key FROM cache ORDER BY created DESC LIMIT -1 OFFSET ?)',
+            (self.maxsize,))
+
+    def __len__(self):
+        try:
+            return self._connection().execute(
+                'SELECT COUNT(*) FROM cache').fetchone()[0]
+        except sqlite3.Error:
+            return 0
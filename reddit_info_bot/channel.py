@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Search result channel
+
+Results and control messages are sent from the search processes
+to the bot as length-prefixed frames: a 5 byte header (payload length,
+serializer id) followed by the serialized message. Each frame names
+its own serializer, so the reading side needs no configuration,
+and a message which fails to decode is skipped without losing
+track of the ones that follow.
+
+Messages are dicts; control messages carry a '_control' key
+('first_request', 'finished', 'error', 'stats', 'end', ...).
+"""
+from __future__ import absolute_import, unicode_literals
+import os
+import json
+import time
+import errno
+import select
+import struct
+import marshal
+import logging
+from six.moves import cPickle as pickle
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct(b'>IB')
+MAX_FRAME_SIZE = 64 * 1024 * 1024 # anything larger means a corrupted stream
+
+
+def _json_dumps(message):
+    return json.dumps(message).encode('utf-8')
+
+def _json_loads(data):
+    return json.loads(data.decode('utf-8'))
+
+def _pickle_dumps(message):
+    return pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+
+# id -> (name, dumps, loads)
+SERIALIZERS = {
+    1: ('marshal', marshal.dumps, marshal.loads),
+    2: ('pickle', _pickle_dumps, pickle.loads),
+    3: ('json', _json_dumps, _json_loads),
+}
+SERIALIZER_IDS = dict((name, id) for id, (name, _, _) in SERIALIZERS.items())
+
+
+class ChannelTimeout(Exception):
+    """Nothing was read from a search channel in time"""
+
+
+def encode_frame(message, serializer='marshal'):
+    serializer_id = SERIALIZER_IDS[serializer]
+    try:
+        data = SERIALIZERS[serializer_id][1](message)
+    except (ValueError, TypeError):
+        # (not a plain data type, pickle can still handle it)
+        serializer_id = SERIALIZER_IDS['pickle']
+        data = _pickle_dumps(message)
+    return HEADER.pack(len(data), serializer_id) + data
+
+
+class FrameWriter(object):
+    """Buffered frame writer
+
+    Frames are collected until `batch_size` bytes are waiting,
+    or until flushed.
+    Writing to a channel whose reader went away is not an error,
+    the frames are dropped and False is returned.
+    """
+
+    def __init__(self, fileobj, serializer='marshal', batch_size=64 * 1024):
+        if serializer not in SERIALIZER_IDS:
+            raise ValueError('Unknown search channel serializer: %s' % serializer)
+        self.fileobj = fileobj
+        self.serializer = serializer
+        self.batch_size = batch_size
+        self._frames = []
+        self._size = 0
+
+    def write(self, message, flush=False):
+        frame = encode_frame(message, self.serializer)
+        self._frames.append(frame)
+        self._size += len(frame)
+        if flush or self._size >= self.batch_size:
+            return self.flush()
+        return True
+
+    def write_frame(self, frame, flush=True):
+        """Pass on an already encoded frame"""
+        self._frames.append(frame)
+        self._size += len(frame)
+        if flush or self._size >= self.batch_size:
+            return self.flush()
+        return True
+
+    def flush(self):
+        if not self._frames:
+            return True
+        data = b''.join(self._frames)
+        self._frames, self._size = [], 0
+        try:
+            self.fileobj.write(data)
+            self.fileobj.flush()
+        except (IOError, OSError) as e:
+            logger.debug('Result channel closed: %s' % e)
+            return False
+        return True
+
+    @property
+    def pending(self):
+        return bool(self._frames)
+
+    def close(self):
+        self.flush()
+        try:
+            self.fileobj.close()
+        except (IOError, OSError):
+            pass
+
+
+class FrameReader(object):
+    """Frame reader for the socket or pipe of a search process
+
+    Reads can time out without losing any data already read.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self._buffer = b''
+
+    def _fill(self, size, deadline):
+        while len(self._buffer) < size:
+            try:
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                        raise ChannelTimeout()
+                data = os.read(self.fd, max(size - len(self._buffer), 65536))
+            except (OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                return False
+            self._buffer += data
+        return True
+
+    def buffered(self):
+        """Whether a complete frame can be read without waiting"""
+        if len(self._buffer) < HEADER.size:
+            return False
+        size, _ = HEADER.unpack(self._buffer[:HEADER.size])
+        return len(self._buffer) >= HEADER.size + size
+
+    def read_frame(self, timeout=None):
+        """Next complete frame, undecoded (None at end of stream)
+
+        Raises ChannelTimeout if none arrived in `timeout` seconds.
+        An incomplete frame at the end of the stream is dropped.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        if not self._fill(HEADER.size, deadline):
+            return None
+        size, _ = HEADER.unpack(self._buffer[:HEADER.size])
+        if size > MAX_FRAME_SIZE:
+            logger.error('Corrupted search channel (frame of %d bytes)' % size)
+            return None
+        if not self._fill(HEADER.size + size, deadline):
+            return None
+        frame = self._buffer[:HEADER.size + size]
+        self._buffer = self._buffer[HEADER.size + size:]
+        return frame
+
+    def read(self, timeout=None):
+        """Next message (None at end of stream)"""
+        while True:
+            frame = self.read_frame(timeout)
+            if frame is None:
+                return None
+            _, serializer_id = HEADER.unpack(frame[:HEADER.size])
+            try:
+                return SERIALIZERS[serializer_id][2](frame[HEADER.size:])
+            except (KeyError, ValueError, TypeError, EOFError, pickle.UnpicklingError) as e:
+                logger.error('Error decoding search channel message (%d bytes): %r' % (
+                    len(frame), e))
@@ -18,9 +18,13 @@ from .reddit import (
     reddit_login, reddit_logout,
     build_subreddit_feeds, handle_bot_action, check_downvotes,
 )
-from .spamfilter import populate_spamfilter_lists
+from .spamfilter import (
+    populate_spamfilter_lists, start_spamfilter_refresh, stop_spamfilter_refresh,
+)
+from .worker import start_search_worker, stop_search_worker
 from .log import setup_logging, release_logging
-from .util import chwd, cached_psl, daemon_context
+from . import util
+from .util import chwd, cached_psl, start_psl_refresh, daemon_context
 from .signals import signal_map, running
 from .exceptions import ConfigurationError
 
@@ -78,7 +82,6 @@ def do_setup(settings, command=None, *a, **kw):
     open_files = {
         'comments_seen': cachedir + 'comments_seen.cache',
         #'spamfilter': cachedir + 'spamfilter.cache',
-        'pubsuflist': cachedir + 'public_suffix_list.dat',
     }
     del cachedir
 
@@ -108,14 +111,34 @@ def do_setup(settings, command=None, *a, **kw):
     with daemon_context(settings, files_preserve=files_preserve, signal_map=signal_map):
         logger.info('%s started' % settings.get('_BOT_INSTANCE_'))
 
-        # force early cache-refreshing spamlists
-        populate_spamfilter_lists(settings.get('_CACHEDIR_'))
         # cache-load psl
-        cached_psl(settings.getdict('_FILE_')['pubsuflist'])
+        # (before the spamlists, which are indexed by domain)
+        cached_psl(settings.get('_CACHEDIR_'), memo_size=settings.getint('PSL_MEMO_SIZE'))
+        # force early cache-refreshing spamlists
+        populate_spamfilter_lists(settings.get('_CACHEDIR_'),
+            verdict_cache_size=settings.getint('SPAMFILTER_VERDICT_CACHE_SIZE'),
+            sync_concurrency=settings.getint('SPAMFILTER_SYNC_CONCURRENCY'),
+            prefilter=settings.getbool('SPAMFILTER_BLOOM_PREFILTER'))
+
+        # searches are run by a long-lived worker process
+        # (forked before any background threads run, later forks use util.fork)
+        mode = settings.get('SEARCH_WORKER_MODE')
+        if mode in ('worker', 'forkserver'):
+            start_search_worker(settings, mode)
+
+        # and keep the lists fresh, off the main loop
+        start_psl_refresh(settings.get('_CACHEDIR_'), settings.getint('PSL_MAX_AGE'))
+        start_spamfilter_refresh(settings.getint('SPAMFILTER_REFRESH_INTERVAL'))
 
         if callable(command):
             command(settings, *a, **kw)
 
+        stop_search_worker()
+        stop_spamfilter_refresh()
+        if hasattr(util.psl_cached, 'stats'):
+            logger.debug('PublicSuffixList lookups: %(hits)d memoized, %(misses)d computed'
+                         % util.psl_cached.stats())
+
         logger.info('%s shutting down' % settings.get('_BOT_INSTANCE_'))
         release_logging(log_handler)
 
@@ -252,9 +275,10 @@ def cmd_imagesearch(settings, image_url=None, image_data=None, image_ext='jpg',
     display_limit = settings.getint('BOTCMD_IMAGESEARCH_MAXRESULTS_FOR_ENGINE', 15)
     wordcloud = settings.getbool('BOTCMD_WORDCLOUD_ENABLED', not from_cli)
 
+    search_status = {}
     search_results = image_search(settings,
             image_url=image_url, image_data=image_data, num_results=display_limit,
-            image_ext=image_ext,
+            image_ext=image_ext, display_limit=display_limit, status=search_status,
         )
 
     if wordcloud:
@@ -290,7 +314,9 @@ def cmd_imagesearch(settings, image_url=None, image_data=None, image_ext='jpg',
         logger.info('...Imgur link: %s -- Metadata:\n%s' % (imgur_link, pprint.pformat(idata)))
 
     reply_contents = format_image_search(settings, filter_results,
-            escape_chars=not from_cli, metainfo={'wordcloud':imgur_link})
+            escape_chars=not from_cli, metainfo={'wordcloud':imgur_link,
+                                                 'timed_out':search_status.get('timed_out'),
+                                                 'skipped':search_status.get('skipped')})
 
     if from_cli: # being called directly, dump output to terminal
         logger.info('Image-search results:\n%s' % reply_contents)
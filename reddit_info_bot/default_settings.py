@@ -105,6 +105,12 @@ A wordcloud of all search results was generated and [is available on Imgur]({wor
 BOTCMD_IMAGESEARCH_NO_SEARCHENGINE_RESULTS_MESSAGE = (
 """No available links from this search engine found."""
 )
+BOTCMD_IMAGESEARCH_SEARCHENGINE_TIMED_OUT_MESSAGE = ( # instead of the above, if the search engine did not answer in time
+"""This search engine did not answer in time."""
+)
+BOTCMD_IMAGESEARCH_SEARCHENGINE_SKIPPED_MESSAGE = ( # instead, if the search engine was not asked (failing lately)
+"""This search engine is unavailable at the moment."""
+)
 BOTCMD_IMAGESEARCH_NO_RESULTS_MESSAGE = (
 """No search results found."""
 )
@@ -150,6 +156,25 @@ BOTCMD_WORDCLOUD_STOPWORDS = [ # additional stopwords to merge with wordcloud st
 COMMENT_REPLY_AGE_LIMIT = 0 # ignore comments older than X minutes
 
 
+SPAMFILTER_SYNC_CONCURRENCY = 3 # spam filter lists downloaded in parallel
+SPAMFILTER_VERDICT_CACHE_SIZE = 50000 # spam-check results kept across searches (0 disables)
+SPAMFILTER_BLOOM_PREFILTER = False # rule out clean results using compact bloom filters first
+SPAMFILTER_REFRESH_INTERVAL = 3600 # seconds between background checks for outdated spam filter lists (0 disables)
+PSL_MAX_AGE = 604800 # seconds before the public suffix list is downloaded again (0 never)
+PSL_MEMO_SIZE = 10000 # public suffix lookups remembered, by host
+SEARCH_WORKER_MODE = 'worker' # 'worker' (persistent search process), 'forkserver' (pre-warmed process per search) or 'fork' (new process per search)
+SEARCH_DEADLINE = 120 # seconds an image search may take, then its partial results are used (0 disables)
+SEARCH_PROVIDER_DEADLINES = {} # shorter deadlines for single search engines, e.g. {'Bing': 60}
+SEARCH_BREAKER_FAILURES = 3 # failed searches in a row (banned, errors, no answer) before a search engine is skipped (0 never skips)
+SEARCH_BREAKER_COOLDOWN = 600 # seconds it is skipped, then tried again (doubling each time that fails too)
+SEARCH_BREAKER_MAX_COOLDOWN = 21600 # ...but skipped no longer than this
+SEARCH_CACHE_SIZE = 2000 # image searches whose results are kept for repeat searches of the same image (0 disables)
+SEARCH_CACHE_TTL = 21600 # seconds the results of a complete search are reused
+SEARCH_CACHE_PARTIAL_TTL = 900 # ...of a search some engines didn't finish (timed out, failed, skipped; 0 doesn't keep them)
+SEARCH_CHANNEL_SERIALIZER = 'marshal' # how results are sent from the search process: 'marshal' (fastest), 'pickle' or 'json'
+SEARCH_CHANNEL_FLUSH_INTERVAL = 0.05 # seconds results may be held back to send them in batches (0 sends each at once)
+
+
 IMAGE_EXTENSIONS = ['tif', 'tiff', 'gif', 'jpeg', 'jpg', 'jif', 'jfif', 'jp2', 'jpx', 'j2k', 'j2c', 'fpx', 'pcd', 'png']
 VIDEO_EXTENSIONS = ['mp4', 'webm', 'ogg']
 OTHER_EXTENSIONS = ['gifv'] # imaginary gif-video format (mp4/webm), treat as website when scraping
@@ -176,6 +201,24 @@ SUBREDDITS = [ # list of /r/<subreddits> to watch
 USER_AGENT = '%s/%s' % (BOT_NAME, BOT_VERSION)
 DOWNLOAD_TIMEOUT = 360 # in seconds
 DOWNLOAD_TIMEOUT_LINKCHECK = 30
+LINKCHECK_MAX_BYTES = 4096 # link-checks read only the start of a page (0 reads all of it)
+LINKCHECK_MARGIN = 3 # results link-checked beyond the display limit, more only if some are broken (-1 checks all)
+LINKCHECK_CACHE_SIZE = 100000 # link-check outcomes kept across searches (0 disables caching)
+LINKCHECK_CACHE_TTL = 86400 # seconds a good link is not checked again
+LINKCHECK_CACHE_BROKEN_TTL = 1800 # seconds a broken link is not checked again
+LINKCHECK_HOST_FAILURES = 3 # skip hosts which timed out or refused connections this many times in a row
+LINKCHECK_HOST_FAILURE_TTL = 900 # ...for this many seconds since their last failure
+LINKCHECK_CONCURRENCY = 16 # link-checks running at once, per search engine (0 for no limit)
+LINKCHECK_CONCURRENCY_PER_HOST = 2 # ...to the same host
+LINKCHECK_DELAY = 0 # seconds between link-checks to the same host, at least (auto-throttled above that)
+LINKCHECK_TARGET_CONCURRENCY = 2.0 # auto-throttling aims for this many link-checks at once per host
+SEARCH_ENGINE_PROFILES = { # scrapy download settings per search engine, throttling it apart from link-checks
+    'KarmaDecay': {'CONCURRENT_REQUESTS_PER_DOMAIN': 2, 'AUTOTHROTTLE_TARGET_CONCURRENCY': 1.0},
+    'Yandex': {'CONCURRENT_REQUESTS_PER_DOMAIN': 4, 'AUTOTHROTTLE_TARGET_CONCURRENCY': 2.0, 'DOWNLOAD_DELAY': 0.25},
+    'Bing': {'CONCURRENT_REQUESTS_PER_DOMAIN': 2, 'AUTOTHROTTLE_TARGET_CONCURRENCY': 1.0},
+    'Tineye': {'CONCURRENT_REQUESTS_PER_DOMAIN': 1, 'AUTOTHROTTLE_TARGET_CONCURRENCY': 1.0, 'DOWNLOAD_DELAY': 1},
+    'Google': {'CONCURRENT_REQUESTS_PER_DOMAIN': 1, 'AUTOTHROTTLE_TARGET_CONCURRENCY': 1.0, 'DOWNLOAD_DELAY': 1},
+}
 
 AUTOTHROTTLE_ENABLED = True
 COOKIES_ENABLED = True
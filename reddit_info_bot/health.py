@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Search engine health
+
+A circuit breaker per search engine (provider), kept across searches.
+After SEARCH_BREAKER_FAILURES failed searches in a row (banned,
+an unexpected search results page, errors, no answer in time) the
+circuit opens: the engine is skipped for SEARCH_BREAKER_COOLDOWN seconds.
+Then it's 'half-open', the next search tries the engine again. If that
+goes well the circuit is closed, if not it opens for twice as long.
+"""
+from __future__ import absolute_import, unicode_literals
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class CircuitBreaker(object):
+    """Circuit breakers for a set of providers
+
+    The state is kept in `cache` (a SqliteCache) if there is one,
+    so it outlives the bot process.
+    """
+
+    def __init__(self, cache=None, failures=3, cooldown=600, max_cooldown=21600):
+        self.cache = cache
+        self.failures = failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._states = {}
+
+    def _load(self, provider):
+        state = None
+        if self.cache is not None:
+            state = self.cache.get('breaker:%s' % provider)
+        if state is None:
+            state = self._states.get(provider)
+        return dict(state or {'state': CLOSED, 'failures': 0, 'trips': 0,
+                              'opened': None, 'reason': None})
+
+    def _save(self, provider, state):
+        self._states[provider] = state
+        if self.cache is not None:
+            self.cache.set('breaker:%s' % provider, state)
+
+    def cooldown_for(self, state):
+        """Seconds an open circuit stays open"""
+        trips = max(state['trips'], 1)
+        return min(self.cooldown * 2 ** (trips - 1), self.max_cooldown or float('inf'))
+
+    def state(self, provider):
+        return self._load(provider)
+
+    def states(self, providers):
+        return dict((provider, self._load(provider)['state']) for provider in providers)
+
+    def allow(self, provider):
+        """Whether to search `provider` now"""
+        state = self._load(provider)
+        if state['state'] != OPEN:
+            return True
+        reopens = state['opened'] + self.cooldown_for(state)
+        if time.time() < reopens:
+            logger.debug('%s search circuit open (%s), skipped for another %ds' % (
+                provider, state['reason'], reopens - time.time()))
+            return False
+        state['state'] = HALF_OPEN
+        self._save(provider, state)
+        logger.info('%s search circuit half-open, trying it again' % provider)
+        return True
+
+    def record(self, provider, failure=None):
+        """Note the outcome of a search: `failure` is why it failed, if it did"""
+        state = self._load(provider)
+        if not failure:
+            if state['state'] != CLOSED:
+                logger.info('%s search circuit closed, %s is answering again' % (provider, provider))
+            if state['state'] != CLOSED or state['failures']:
+                self._save(provider, {'state': CLOSED, 'failures': 0, 'trips': 0,
+                                      'opened': None, 'reason': None})
+            return
+
+        state['failures'] += 1
+        state['reason'] = failure
+        if state['state'] == HALF_OPEN or state['failures'] >= self.failures:
+            state['trips'] = state['trips'] + 1 if state['state'] == HALF_OPEN else 1
+            state['state'] = OPEN
+            state['opened'] = time.time()
+            logger.warning('%s search circuit open after %d failed searches (%s), '
+                           'skipping it for %ds' % (provider, state['failures'], failure,
+                                                    self.cooldown_for(state)))
+        else:
+            logger.info('%s search failed (%s), %d of %d before skipping it' % (
+                provider, failure, state['failures'], self.failures))
+        self._save(provider, state)
+
+
+def search_failure(reason, stats, errors, found):
+    """Why a provider's search failed, None if it didn't
+
+    `reason` the spider finished with, its `stats` and `errors`,
+    and the number of results `found`.
+    """
+    stats = stats or {}
+    for key in sorted(stats):
+        if key.startswith('search/failed/'):
+            return key[len('search/failed/'):]
+    for status in (403, 429):
+        if stats.get('httperror/response_ignored_status_count/%d' % status):
+            return 'banned'
+    if found:
+        return None
+    if reason == 'deadline':
+        return 'timeout'
+    if errors or stats.get('retry/max_reached'):
+        return 'error'
+    return None
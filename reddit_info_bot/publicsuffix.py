@@ -11,8 +11,11 @@ License: MIT
 """
 
 import codecs
+import os
 import os.path
+import threading
 import warnings
+from collections import OrderedDict
 
 try:
 	from urllib.request import urlopen, Request
@@ -38,17 +41,68 @@ def fetch(url=PUBLIC_SUFFIX_LIST_URL, user_agent='Python-publicsuffix/1.1.1'):
 
 	return f
 
+def normalize_host(domain):
+	"""Lowercased host name from a domain or URL netloc
+
+	Drops userinfo and port, and decodes IDNA (punycode) labels,
+	as the public suffix list uses decoded names.
+	Returns the plain host labels and the decoded labels.
+	"""
+	host = domain.rpartition('@')[2]
+	if not host.startswith('['): # (no IPv6 literal)
+		host = host.partition(':')[0]
+	parts = host.lower().strip('.').split('.')
+	decoded = parts
+	if any(label.startswith('xn--') for label in parts):
+		decoded = []
+		for label in parts:
+			if label.startswith('xn--'):
+				try:
+					label = label.encode('ascii').decode('idna')
+				except UnicodeError:
+					pass
+			decoded.append(label)
+	return parts, decoded
+
 class PublicSuffixList(object):
-	def __init__(self, input_file):
+	def __init__(self, input_file, memo_size=10000):
 		"""Reads and parses public suffix list.
 
 		input_file is a file object or another iterable that returns
 		lines of a public suffix list file.
 
 		The file format is described at http://publicsuffix.org/list/
+
+		Lookups are memoized per host, for up to memo_size hosts
+		(least recently used are dropped first, 0 disables).
 		"""
 		root = self._build_structure(input_file)
 		self.root = self._simplify(root)
+		self._init_memo(memo_size)
+
+	@classmethod
+	def from_rules(cls, root, memo_size=10000):
+		"""Instance using the already parsed rule tree `root`
+		(a PublicSuffixList's `root`)
+		"""
+		psl = cls.__new__(cls)
+		psl.__setstate__({'root': root, 'memo_size': memo_size})
+		return psl
+
+	def _init_memo(self, memo_size):
+		self.memo_size = memo_size
+		self.hits = self.misses = 0
+		self._memo = OrderedDict()
+		self._lock = threading.Lock()
+		self._pid = os.getpid()
+
+	def __getstate__(self):
+		# only the rules are pickled, the memo starts out empty
+		return {'root': self.root, 'memo_size': self.memo_size}
+
+	def __setstate__(self, state):
+		self.root = state['root']
+		self._init_memo(state['memo_size'])
 
 	def _find_node(self, parent, parts):
 		if not parts:
@@ -70,13 +124,13 @@ class PublicSuffixList(object):
 		return self._find_node(child_node, parts)
 
 	def _add_rule(self, root, rule):
-		if rule.startswith(b'!'):
+		if rule.startswith(u'!'):
 			negate = 1
 			rule = rule[1:]
 		else:
 			negate = 0
 
-		parts = rule.split(b'.')
+		parts = rule.split(u'.')
 		self._find_node(root, parts)[0] = negate
 
 	def _simplify(self, node):
@@ -89,28 +143,39 @@ class PublicSuffixList(object):
 		root = [0]
 
 		for line in fp:
+			if isinstance(line, bytes):
+				line = line.decode('utf-8')
 			line = line.strip()
-			if line.startswith(b'//') or not line:
+			if line.startswith(u'//') or not line:
 				continue
 
-			self._add_rule(root, line.split()[0].lstrip(b'.'))
+			self._add_rule(root, line.split()[0].lstrip(u'.'))
 
 		return root
 
-	def _lookup_node(self, matches, depth, parent, parts):
-		if parent in (0, 1):
-			negate = parent
-			children = None
-		else:
-			negate, children = parent
-
-		matches[-depth] = negate
-
-		if depth < len(parts) and children:
-			for name in ('*', parts[-depth]):
-				child = children.get(name, None)
-				if child is not None:
-					self._lookup_node(matches, depth+1, child, parts)
+	def _lookup(self, parts):
+		"""Number of trailing labels in `parts` forming the registrable domain"""
+		# depth -> whether the rule ending there is an exception
+		# (depth-first, wildcard before exact names, later matches win)
+		marks = {}
+		stack = [(1, self.root)]
+		while stack:
+			depth, node = stack.pop()
+			if node in (0, 1):
+				negate = node
+				children = None
+			else:
+				negate, children = node
+
+			marks[depth] = negate
+
+			if depth < len(parts) and children:
+				for name in (parts[-depth], u'*'): # (stack, reverse order)
+					child = children.get(name, None)
+					if child is not None:
+						stack.append((depth+1, child))
+
+		return max(depth for depth, negate in marks.items() if negate == 0)
 
 	def get_public_suffix(self, domain):
 		"""get_public_suffix("www.example.com") -> "example.com"
@@ -118,16 +183,45 @@ class PublicSuffixList(object):
 		Calling this function with a DNS name will return the
 		public suffix for that name.
 
-		Note that for internationalized domains the list at
-		http://publicsuffix.org uses decoded names, so it is
-		up to the caller to decode any Punycode-encoded names.
+		Punycode-encoded names are decoded for the lookup
+		(the list at http://publicsuffix.org uses decoded names),
+		the result keeps the encoding of `domain`.
 		"""
-
-		parts = domain.lower().strip('.').split('.')
-		hits = [None] * len(parts)
-
-		self._lookup_node(hits, 1, self.root, parts)
-
-		for i, what in enumerate(hits):
-			if what is not None and what == 0:
-				return '.'.join(parts[i:])
+		if not self.memo_size:
+			return self._get_public_suffix(domain)
+
+		if self._pid != os.getpid():
+			# lock may have been held by another thread while forking
+			self._lock = threading.Lock()
+			self._pid = os.getpid()
+
+		with self._lock:
+			suffix = self._memo.pop(domain, None)
+			if suffix is not None:
+				self._memo[domain] = suffix # most recently used
+				self.hits += 1
+				return suffix
+
+		suffix = self._get_public_suffix(domain)
+
+		with self._lock:
+			self.misses += 1
+			self._memo[domain] = suffix
+			while len(self._memo) > self.memo_size:
+				self._memo.popitem(last=False)
+		return suffix
+
+	def _get_public_suffix(self, domain):
+		parts, decoded = normalize_host(domain)
+		return '.'.join(parts[-self._lookup(decoded):])
+
+	def stats(self):
+		"""Lookup memo statistics"""
+		lookups = self.hits + self.misses
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+			'size': len(self._memo),
+			'max_size': self.memo_size,
+		}
@@ -1,15 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 import os
+import time
+import signal
 import logging
 import string
-import json
 import six
+import hashlib
 from collections import OrderedDict
 from six.moves.urllib.parse import urlsplit, urlunsplit
 from scrapy.item import Item, Field
 
-from .util import domain_suffix, sanitize_string
+from .util import domain_suffix, sanitize_string, fork
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +41,11 @@ class SearchResultItem(Item):
     spam = Field()
     # results marked broken by link-check
     broken = Field()
+    # results not link-checked, as enough others were good
+    unchecked = Field()
+    # as seen by link-check (of image_url if there is one, else url)
+    content_type = Field()
+    content_length = Field()
 
     # unused
     image_thumb_url = Field()
@@ -95,20 +102,16 @@ def find_media_url(url, settings):
 
     return url
 
-def image_search(settings, **spiderargs):
-    from .spiders import crawler_setup
+def _fork_search(settings, deadline=None, **spiderargs):
+    """Run a search in a forked child process, yield the results
 
-    image_url = spiderargs.get('image_url')
-    image_data = spiderargs.get('image_data')
-    if image_url:
-        logger.info('Image-searching for %s' % image_url)
-    elif image_data:
-        logger.info('Image-searching for (image data)')
-    else:
-        return
+    (`deadline` as for SearchWorker.search)
+    """
+    from .spiders import crawler_setup
+    from .channel import FrameReader, ChannelTimeout
 
     pipein, pipeout = os.pipe()
-    pid = os.fork()
+    pid = fork()
     if pid < 0:
         raise OSError('Forking child process failed.')
 
@@ -125,47 +128,348 @@ def image_search(settings, **spiderargs):
 
     # parent process
     os.close(pipeout)
-    reader = os.fdopen(pipein, 'rb')
+    reader = FrameReader(pipein)
+    done = False
+    try:
+        while True:
+            timeout = deadline and deadline()
+            if timeout is not None:
+                timeout = max(timeout - time.time(), 0)
+            try:
+                result = reader.read(timeout)
+            except ChannelTimeout:
+                yield {'_control': 'timeout'}
+                continue
+            if result is None:
+                logger.error('Search process exited before the end of its results')
+                break
+            if result.get('_control') == 'end':
+                break
+            result.pop('_job', None)
+            yield result
+        done = True
+    finally:
+        if not done: # (search cancelled)
+            os.kill(pid, signal.SIGKILL)
+        pid, status = os.waitpid(pid, 0)
+        os.close(pipein)
 
-    results = {}
-    while True:
-        # simple line-based protocol
-        data = reader.readline()[:-1]
-        if not data or len(data) == 0:
-            break
+SEARCH_PROVIDERS = ['KarmaDecay', 'Yandex', 'Bing', 'Tineye', 'Google']
+
+def log_linkcheck_stats(stats):
+    """Log link-check counts summed over the providers' `stats`"""
+    count = lambda key: sum((s or {}).get('linkcheck/%s' % key, 0) for s in stats.values())
+    hits, misses = count('cache_hit'), count('cache_miss')
+    if not (hits or misses or count('checked')):
+        return
+    logger.info('Link-checks: %d checked, %d shared, %d cached (%.0f%% cache hits), '
+                '%d skipped (failing hosts), %d not needed' % (count('checked'), count('shared'), hits,
+                100.0 * hits / (hits + misses) if hits + misses else 0,
+                count('host_skipped'), count('unchecked')))
+
+provider_breaker = None
+
+def open_provider_breaker(settings):
+    """Search engine circuit breakers, kept across searches (if enabled)"""
+    global provider_breaker
+    from .cache import SqliteCache
+    from .health import CircuitBreaker
+
+    failures = settings.getint('SEARCH_BREAKER_FAILURES')
+    if provider_breaker is None and failures:
+        cache = SqliteCache('{0}providers.sqlite'.format(settings.get('_CACHEDIR_', '')),
+                            maxsize=100)
+        provider_breaker = CircuitBreaker(cache, failures=failures,
+            cooldown=settings.getfloat('SEARCH_BREAKER_COOLDOWN'),
+            max_cooldown=settings.getfloat('SEARCH_BREAKER_MAX_COOLDOWN'))
+    return provider_breaker
+
+search_cache = None
+
+def open_search_cache(settings):
+    """Image search results kept for repeat searches (if enabled)"""
+    global search_cache
+    from .cache import SqliteCache
+
+    size = settings.getint('SEARCH_CACHE_SIZE')
+    if search_cache is None and size:
+        search_cache = SqliteCache('{0}imagesearch.sqlite'.format(settings.get('_CACHEDIR_', '')),
+                                   maxsize=size)
+    return search_cache
+
+def search_cache_keys(settings, image_url=None, image_data=None):
+    """Keys an image search is cached under
+
+    The media URL as searched (see find_media_url), normalized,
+    and a hash of the image data, if there is any.
+    """
+    keys = []
+    if image_url:
+        url = find_media_url(image_url, settings)
+        (scheme, netloc, path, query, fragment) = urlsplit(url.strip())
+        scheme = scheme.lower()
+        netloc = netloc.lower()
+        for port in (':80', ':443'):
+            if netloc.endswith(port):
+                netloc = netloc[:-len(port)]
+        if scheme == 'https':
+            scheme = 'http' # (same image)
+        keys.append('url:%s' % urlunsplit((scheme, netloc, path or '/', query, '')))
+    if image_data:
+        keys.append('sha1:%s' % hashlib.sha1(image_data).hexdigest())
+    return keys
+
+def search_cache_tag():
+    """Tag of cached searches still valid now
+
+    (their results were marked spam by the spam filter lists of the time)
+    """
+    from .spamfilter import LISTS
+    return LISTS.get('version')
 
-        result = None
-        try:
-            result = json.loads(data)
-        except ValueError:
-            logger.error('Error decoding Spider data: %s' % (data,))
-        if not result:
+def search_complete(status, display_limit=None):
+    """Whether every provider finished searching (or found enough), without errors
+
+    (download failures included, as the circuit breaker counts them)
+    """
+    from .health import search_failure
+
+    if status.get('timed_out') or status.get('skipped') or status.get('errors'):
+        return False
+    finished = status.get('finished') or {}
+    verified = status.get('verified') or {}
+    stats = status.get('stats') or {}
+    found = status.get('found') or {}
+    for provider in SEARCH_PROVIDERS:
+        if search_failure(finished.get(provider), stats.get(provider),
+                          None, found.get(provider, 0)):
+            return False
+        if finished.get(provider) == 'finished':
+            continue
+        if display_limit and verified.get(provider, 0) >= display_limit:
             continue
-        # result must have a search provider
-        if not 'provider' in result:
-            continue # should not happen
+        return False
+    return True
 
-        result = SearchResultItem(result)
+def search_deadlines(settings, started):
+    """Time by which each provider's search must be done (if limited)
 
+    The end-to-end SEARCH_DEADLINE applies to every provider,
+    SEARCH_PROVIDER_DEADLINES can set shorter ones per provider.
+    """
+    deadline = settings.getfloat('SEARCH_DEADLINE')
+    provider_deadlines = settings.getdict('SEARCH_PROVIDER_DEADLINES') or {}
+    deadlines = {}
+    for provider in SEARCH_PROVIDERS:
+        limits = [float(x) for x in (deadline, provider_deadlines.get(provider)) if x]
+        if limits:
+            deadlines[provider] = started + min(limits)
+    return deadlines
+
+def iter_image_search(settings, display_limit=None, status=None, **spiderargs):
+    """Image search, yielding each SearchResultItem as it arrives
+
+    With a `display_limit`, the search is cancelled as soon as every
+    provider has either finished or found that many verified results
+    (neither spam nor broken links).
+    Providers still searching at their deadline are given up on,
+    keeping the results they found so far.
+    Providers whose circuit breaker is open are not searched (see
+    .health), the outcome of the search is recorded for the others.
+    If a `status` dict is passed, it is filled with the 'timed_out'
+    providers, the 'finished' ones (with their reason), the spider
+    'errors', 'stats' and number of results 'found' and 'verified' per provider,
+    the 'skipped' providers, the 'breaker' state of each,
+    and the 'elapsed' search time.
+    """
+    from .worker import search_worker
+    from .health import search_failure
+
+    started = time.time()
+    image_url = spiderargs.get('image_url')
+    image_data = spiderargs.get('image_data')
+    if image_url:
+        logger.info('Image-searching for %s' % image_url)
+    elif image_data:
+        logger.info('Image-searching for (image data)')
+    else:
+        return
+
+    breaker = open_provider_breaker(settings)
+    providers = list(SEARCH_PROVIDERS)
+    if breaker is not None:
+        providers = [provider for provider in providers if breaker.allow(provider)]
+    skipped = sorted(set(SEARCH_PROVIDERS) - set(providers))
+    if skipped:
+        logger.warning('Not searching %s (circuit open)' % ', '.join(skipped))
+        spiderargs['providers'] = providers
+
+    verified = dict((provider, 0) for provider in providers)
+    found = dict((provider, 0) for provider in providers)
+    pending = set(providers) # (neither finished nor enough results)
+    timed_out = set()
+    finished = {}
+    errors = {}
+    stats = {}
+    deadlines = search_deadlines(settings, started)
+
+    def next_deadline():
+        waiting = [deadlines[provider] for provider in pending if provider in deadlines]
+        return min(waiting) if waiting else None
+
+    mode = settings.get('SEARCH_WORKER_MODE', 'fork')
+    if not providers:
+        search = (result for result in ()) # (all skipped)
+    elif mode in ('worker', 'forkserver') and search_worker is not None:
+        search = search_worker.search(started=started, deadline=next_deadline, **spiderargs)
+    else:
+        mode = 'fork'
+        search = _fork_search(settings, started=started, deadline=next_deadline, **spiderargs)
+
+    try:
+        for result in search:
+            control = result.get('_control')
+            if control == 'first_request':
+                logger.info('Search startup: first request after %.3fs (%s mode)' % (
+                    result['latency'], mode))
+                continue
+            if control == 'finished':
+                provider = result['provider']
+                pending.discard(provider)
+                finished[provider] = result.get('reason')
+                if result.get('reason') == 'deadline':
+                    timed_out.add(provider)
+                logger.debug('%s search finished after %.2fs (%s)' % (
+                    provider, time.time() - started, result.get('reason')))
+            elif control == 'error':
+                errors.setdefault(result['provider'], []).append(result.get('error'))
+            elif control == 'stats':
+                stats[result['provider']] = result.get('stats')
+            elif control:
+                pass
+            # result must have a search provider
+            elif not 'provider' in result:
+                continue # should not happen
+            else:
+                result = SearchResultItem(result)
+                provider = result['provider']
+                found[provider] = found.get(provider, 0) + 1
+                if not (result.get('spam') or result.get('broken') or result.get('unchecked')):
+                    verified[provider] = verified.get(provider, 0) + 1
+                    if display_limit and verified[provider] >= display_limit:
+                        pending.discard(provider)
+                yield result
+
+            now = time.time()
+            for provider in list(pending):
+                if provider in deadlines and deadlines[provider] <= now:
+                    pending.discard(provider)
+                    timed_out.add(provider)
+            if not pending:
+                break
+    finally:
+        search.close()
+
+    if breaker is not None:
+        for provider in providers:
+            if provider not in finished and provider not in timed_out and not found[provider]:
+                continue # (cancelled, nothing to tell)
+            reason = finished.get(provider, 'deadline')
+            breaker.record(provider, search_failure(reason, stats.get(provider),
+                                                    errors.get(provider), found[provider]))
+
+    elapsed = time.time() - started
+    if timed_out:
+        logger.warning('Search deadline passed for %s, partial results after %.2fs' % (
+            ', '.join(sorted(timed_out)), elapsed))
+    elif display_limit:
+        logger.debug('Enough results, search finished after %.2fs' % elapsed)
+    log_linkcheck_stats(stats)
+    if status is not None:
+        status.update(timed_out=sorted(timed_out), finished=finished,
+                      errors=errors, stats=stats, found=found, verified=verified,
+                      skipped=skipped, elapsed=elapsed,
+                      breaker=breaker.states(SEARCH_PROVIDERS) if breaker is not None else {})
+
+def image_search(settings, display_limit=None, status=None, **spiderargs):
+    """Image search, returning the SearchResultItems by provider
+
+    Results are cached (see open_search_cache) by the image searched
+    for, complete searches for SEARCH_CACHE_TTL seconds, those some
+    providers didn't finish for SEARCH_CACHE_PARTIAL_TTL, searches
+    which found nothing not at all. A repeat search returns them
+    (and its `status` gets 'cached': True).
+    """
+    cache = open_search_cache(settings)
+    keys = []
+    if cache is not None:
+        keys = search_cache_keys(settings, spiderargs.get('image_url'), spiderargs.get('image_data'))
+        tag = search_cache_tag()
+        results = cached_image_search(cache, keys, tag, display_limit, status)
+        if results is not None:
+            return results
+
+    if status is None:
+        status = {}
+    results = {}
+    for result in iter_image_search(settings, display_limit=display_limit,
+                                    status=status, **spiderargs):
         provider = result['provider']
         if not provider in results:
             results[provider] = []
 
         results[provider].append(result)
 
-    pid, status = os.waitpid(pid, 0)
-    reader.close()
-
     # do not forget about empty results
-    providers = ['KarmaDecay', 'Yandex', 'Bing', 'Tineye', 'Google']
-    for provider in providers:
+    for provider in SEARCH_PROVIDERS:
         if not provider in results:
             results[provider] = []
 
     # sort (by provider) for constant key order
     results = OrderedDict(sorted(results.items()))
+
+    if keys:
+        complete = search_complete(status, display_limit)
+        ttl = settings.getint('SEARCH_CACHE_TTL' if complete else 'SEARCH_CACHE_PARTIAL_TTL')
+        if not any(results.values()):
+            ttl = 0 # (nothing to keep, may well have been a network failure)
+        if ttl > 0:
+            cached = {
+                'results': [(provider, [dict(result) for result in found])
+                            for provider, found in results.items()],
+                'status': dict((key, status.get(key)) for key in ('timed_out', 'skipped')),
+                'display_limit': display_limit,
+                'searched': time.time(),
+                'expires': time.time() + ttl,
+            }
+            for key in keys:
+                cache.set(key, cached, tag=tag)
     return results
 
+def cached_image_search(cache, keys, tag, display_limit=None, status=None):
+    """Results of an earlier image search for one of `keys` (None if there are none)
+
+    Only searches with the same or a higher `display_limit` will do
+    (results were link-checked as far as it needed).
+    """
+    started = time.time()
+    for key in keys:
+        cached = cache.get(key, tag=tag)
+        if cached is None or cached['expires'] < started:
+            continue
+        limit = cached['display_limit']
+        if limit and (not display_limit or limit < display_limit):
+            continue
+        results = OrderedDict((provider, [SearchResultItem(result) for result in found])
+                              for provider, found in cached['results'])
+        elapsed = time.time() - started
+        logger.info('Image search results from cache (%s, searched %ds ago), in %.3fs' % (
+            key, started - cached['searched'], elapsed))
+        if status is not None:
+            status.update(cached['status'], cached=True, elapsed=elapsed)
+        return results
+    return None
+
 def filter_image_search(settings, search_results, account1=None, account2=None, display_limit=None):
 
     from .reddit import reddit_messagefilter
@@ -193,6 +497,9 @@ def filter_image_search(settings, search_results, account1=None, account2=None,
             # remove items marked broken
             if 'broken' in result and result['broken']:
                 continue
+            # and those which weren't needed (not link-checked)
+            if 'unchecked' in result and result['unchecked']:
+                continue
             filtered_results[provider].append(result)
 
         if not filtered_results[provider]:
@@ -259,6 +566,12 @@ def format_image_search(settings, search_results, metainfo={}, escape_chars=True
     results_item_format = settings.getstr('BOTCMD_IMAGESEARCH_RESULT_TEMPLATE')
     results_message_format = settings.getstr('BOTCMD_IMAGESEARCH_MESSAGE_TEMPLATE')
     no_engine_results_message = settings.getstr('BOTCMD_IMAGESEARCH_NO_SEARCHENGINE_RESULTS_MESSAGE')
+    timed_out_message = settings.getstr('BOTCMD_IMAGESEARCH_SEARCHENGINE_TIMED_OUT_MESSAGE',
+                                        no_engine_results_message)
+    timed_out = metainfo.get('timed_out') or []
+    skipped_message = settings.getstr('BOTCMD_IMAGESEARCH_SEARCHENGINE_SKIPPED_MESSAGE',
+                                      no_engine_results_message)
+    skipped = metainfo.get('skipped') or []
     footer_message = settings.getstr('FOOTER_INFO_MESSAGE')
 
     def reddit_format_results(results, escape_chars=True):
@@ -309,7 +622,9 @@ def format_image_search(settings, search_results, metainfo={}, escape_chars=True
             if not results:
                 reply += results_message_format.format(
                         search_engine=provider,
-                        search_results=no_engine_results_message,
+                        search_results=timed_out_message if provider in timed_out
+                                       else skipped_message if provider in skipped
+                                       else no_engine_results_message,
                     )
                 continue
 
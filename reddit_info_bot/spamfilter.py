@@ -4,15 +4,29 @@ import sys
 import os
 import logging
 import time
-import pickle
+import re
 import json
+import struct
+import zlib
+import hashlib
+import threading
 import requests
+from collections import OrderedDict
+from six.moves import cPickle as pickle
+from multiprocessing.pool import ThreadPool
 from requests.exceptions import HTTPError, ConnectionError, Timeout
 try:
     from urllib.parse import urlparse, urlunparse
 except ImportError:
     from urlparse import urlparse, urlunparse
-from .util import domain_suffix, tld_from_suffix, remove_control_characters
+from .util import (
+    domain_suffix, tld_from_suffix, remove_control_characters,
+    write_file_atomic, url_netloc, psl_signature, file_digest,
+)
+from . import util
+from .ahocorasick import Automaton
+from .bloom import BloomFilter, SubstringPrefilter, _to_bytes
+from .cache import SqliteCache
 
 logger = logging.getLogger(__name__)
 
@@ -32,98 +46,449 @@ def _strip_scheme(url):
     (scheme, netloc, path, params, query, fragment) = urlparse(url)
     return urlunparse(('', netloc, path, params, query, fragment))
 
-def _check(string, list):
-    """ check for string in items in list """
+def _check(string, list, domain=None, matched=None):
+    """ check for string in items in list
+
+    (For a DomainIndex only the items anchored to `domain`,
+     and those not anchored to any domain, are checked.)
+    `matched` is what the list's automaton already found in
+    `string`, if it was run over it before (see PageScanner).
+    """
+    if isinstance(list, DomainIndex):
+        found = [thing for thing in list.candidates(domain) if thing in string]
+        found += list.residual.findall(string) if matched is None else matched
+        return '|'.join(found)
+    if isinstance(list, Automaton):
+        return '|'.join(list.findall(string) if matched is None else matched)
     return '|'.join([thing for thing in list if thing in string])
 
 
-def sync_rarchives_spamdb(filter_type, last_update=None):
+_hostname_re = re.compile(r'^[\w-]+(\.[\w-]+)+$', re.UNICODE)
+
+def _rule_domain(rule):
+    """The registrable domain a link rule is anchored to, if any
+
+    ('//www.example.com/spam' and 'example.com/spam' are,
+     'spam' or '/path/spam' are not.)
+    """
+    rule = _strip_scheme(rule)
+    if not rule.startswith('//'):
+        rule = '//' + rule
+    domain, fulldomain = domain_suffix(rule)
+    if not domain or not _hostname_re.match(fulldomain):
+        return None
+    if not tld_from_suffix(domain):
+        return None
+    return domain
+
+class DomainIndex(object):
+    """Link rules, bucketed by the domain they are anchored to
+
+    A URL can only be matched by the rules for its own (registrable)
+    domain, plus the residual rules which don't name a host,
+    so only those are checked.
+    Iterating a DomainIndex yields all rules.
+    """
+
+    def __init__(self, rules):
+        buckets = {}
+        residual = []
+        for rule in rules:
+            domain = _rule_domain(rule)
+            if domain:
+                buckets.setdefault(domain, []).append(rule)
+            else:
+                residual.append(rule)
+        self.buckets = dict((domain, tuple(bucket)) for domain, bucket in buckets.items())
+        self.residual = Automaton(residual)
+
+    def __iter__(self):
+        for bucket in self.buckets.values():
+            for rule in bucket:
+                yield rule
+        for rule in self.residual:
+            yield rule
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values()) + len(self.residual)
+
+    def candidates(self, domain):
+        return self.buckets.get(domain, ())
+
+class Prefilter(object):
+    """Compact, probabilistic stand-in for a spam list
+
+    Tells if a string (on `domain`) could match anything in the list,
+    from Bloom filters alone, without touching the list itself.
+    (So clean results, the vast majority, don't have to walk through
+     the big list structures, which keeps their memory pages shared
+     between forked search processes.)
+    """
+
+    def __init__(self, list):
+        domains = ()
+        if isinstance(list, DomainIndex):
+            domains = list.buckets.keys()
+            list = list.residual
+        self.domains = BloomFilter(len(domains))
+        for domain in domains:
+            self.domains.add(_to_bytes(domain))
+        self.substrings = SubstringPrefilter(list)
+
+    def may_match(self, string, domain=None):
+        if domain is not None and _to_bytes(domain) in self.domains:
+            return True
+        return self.substrings.may_match(string)
+
+
+class PageScanner(object):
+    """One automaton over the patterns of several lists
+
+    Finds in a string what each of the lists' automatons would,
+    in a single pass over it instead of one per list.
+    (Used to check a whole page of results at once.)
+    """
+
+    def __init__(self, *lists):
+        patterns = []
+        self.bounds = [] # end of each list's patterns
+        for list in lists:
+            patterns.extend(list)
+            self.bounds.append(len(patterns))
+        self.automaton = Automaton(patterns)
+
+    def scan(self, strings):
+        """Return {string: matched} for each of the lists (see _check)"""
+        strings = list(set(strings))
+        patterns = self.automaton.patterns
+        found = [{} for bound in self.bounds]
+        for string, indexes in zip(strings, self.automaton.indexes_each(strings)):
+            start = 0
+            for matched, bound in zip(found, self.bounds):
+                matched[string] = [patterns[index] for index in indexes
+                                   if start <= index < bound]
+                start = bound
+        return found
+
+
+RARCHIVES_API_URL = 'http://spambot.rarchives.com/api.cgi'
+
+def _fetch_rarchives(url):
+    try:
+        logger.debug('%s: downloading %s' % (sync_rarchives_spamdb.__name__, url))
+        response = requests.get(url).text
+        data = json.loads(response)
+        if 'error' in data:
+            return (False, data['error'])
+        return (True, data)
+    except (HTTPError, ConnectionError, Timeout, ValueError) as e:
+        return (False, str(e))
+
+def rarchives_last_update():
+    """Time of the last change to the spambot.rarchives.com filters
+
+    (None if unavailable)
+    """
+    ok, data = _fetch_rarchives('%s?method=get_last_update' % RARCHIVES_API_URL)
+    if not ok or 'last_update' not in data:
+        logger.debug('%s: errored: %s' % (rarchives_last_update.__name__, data))
+        return None
+    return data['last_update']
+
+# Checkpoint of a full download: a json header line, then one json line
+# per downloaded page, appended as they arrive.
+CHECKPOINT_VERSION = 2
+
+def _load_checkpoint(filename, filter_type, count):
+    """Resume point of an interrupted full download, if still usable"""
+    try:
+        if time.time() - os.path.getmtime(filename) > 43200:
+            return None
+        with open(filename, 'r') as inf:
+            header = json.loads(inf.readline())
+            if header.get('checkpoint') != CHECKPOINT_VERSION or \
+                    header['type'] != filter_type or header['count'] != count:
+                return None
+            start, filters = 0, []
+            for line in inf:
+                try:
+                    page = json.loads(line)
+                except ValueError: # (cut off mid-write)
+                    break
+                if page['start'] != start:
+                    break
+                filters += page['filters']
+                start += count
+    except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+    if not start:
+        return None
+    return start, filters
+
+def _start_checkpoint(filename, filter_type, count):
+    header = {'checkpoint': CHECKPOINT_VERSION, 'type': filter_type, 'count': count}
+    write_file_atomic(filename, json.dumps(header).encode('utf-8') + b'\n')
+
+def _save_checkpoint(filename, start, filters):
+    """Append a downloaded page (at `start`) to the checkpoint"""
+    with open(filename, 'ab') as outf:
+        outf.write(json.dumps({'start': start, 'filters': filters}).encode('utf-8') + b'\n')
+        outf.flush()
+        os.fsync(outf.fileno())
+
+def sync_rarchives_spamdb(filter_type, last_update=None, checkpoint=None):
     """Pull data from the spambot.rarchives.com database
 
     in a (hopefully) least-bothersome way (since it's just
     a small, and apparently memory-limited, sqlite app).
+
+    Without `last_update`, returns the full `filter_type` dataset (as json).
+    Pages downloaded so far are saved to the `checkpoint` file (if given),
+    so an interrupted download can continue where it stopped.
+    With `last_update`, returns the list of filter changes since that time
+    (oldest first, as dicts with 'spamtext', 'is_active' and 'date' keys).
+    Returns None on failure.
     """
     # This means we pull smallish chunks, iteratively, so the
     # remote db doesn't need to pull a big dataset into memory
     # and lock up or die.
     self = sync_rarchives_spamdb
-    api_url = 'http://spambot.rarchives.com/api.cgi'
-    filters_url = '%s?method=get_filters&start={start}&count={count}&type={type}' % api_url
-    filter_changes_url = '%s?method=get_filter_changes&start={start}&count={count}&type={type}' % api_url
-    last_update_url = '%s?method=get_last_update' % api_url
-
-    def fetch_data(url):
-        try:
-            logger.debug('%s: downloading %s' % (self.__name__, url))
-            response = requests.get(url).text
-            data = json.loads(response)
-            if 'error' in data:
-                return (False, data['error'])
-            return (True, data)
-        except (HTTPError, ConnectionError, Timeout, ValueError) as e:
-            return (False, str(e))
+    filters_url = '%s?method=get_filters&start={start}&count={count}&type={type}' % RARCHIVES_API_URL
+    filter_changes_url = '%s?method=get_filter_changes&start={start}&count={count}&type={type}' % RARCHIVES_API_URL
+    fetch_data = _fetch_rarchives
 
-    if not last_update: # no deltas, fetch everything
-        count = 500 # number of db-results per request, pick a balanced value
-                    # (not too many request, not too much data per request)
-        start = failcount = 0
-        total = count
-        filters = []
+    def fetch_pages(url, count, start=0):
+        """Yield data pages from `url` until the caller is satisfied"""
+        failcount = 0
         while True:
-            ok, data = fetch_data(filters_url.format(start=start, count=count, type=filter_type))
-            if not ok: # or ('filters' not in data):
+            ok, data = fetch_data(url.format(start=start, count=count, type=filter_type))
+            if not ok:
                 logger.debug('%s: errored: %s' % (self.__name__, data))
                 failcount += 1
                 if failcount > 3:
-                    break
+                    return
                 if 'database is locked' in data:
                     # back off and hope the remote will recover
                     time.sleep(failcount*3)
                 # try again
                 logger.debug('%s: retrying (%s)' % (self.__name__, failcount))
                 continue
+            yield start, data
+            start += count
+            failcount = 0
+
+    if not last_update: # no deltas, fetch everything
+        count = 500 # number of db-results per request, pick a balanced value
+                    # (not too many request, not too much data per request)
+        start = 0
+        filters = []
+        resumed = checkpoint and _load_checkpoint(checkpoint, filter_type, count)
+        if resumed:
+            start, filters = resumed
+            logger.info('Resuming download of %s filters at %d' % (filter_type, start))
+        elif checkpoint:
+            _start_checkpoint(checkpoint, filter_type, count)
+        for start, data in fetch_pages(filters_url, count, start):
             if 'filters' not in data or 'total' not in data:
                 # unknown content
                 break
 
-            filters += list(data['filters'])
+            page = list(data['filters'])
+            filters += page
 
-            start += count
             #start = data['start']
             total = int(data['total'])
-            if start > total: # all done
+            if start + count > total: # all done
                 logger.debug('%s: fetched %d %s filters.' % (self.__name__, total, filter_type))
                 filters = json.dumps({
                     'total': total,
                     'type': filter_type,
                     'filters': filters,
                 })
+                if checkpoint and os.path.isfile(checkpoint):
+                    os.unlink(checkpoint)
                 return filters
-            failcount = 0
+            if checkpoint:
+                _save_checkpoint(checkpoint, start, page)
         return None
     else: # compile deltas to patch our local dataset
-        # TODO
+        count = 100 # changes are listed newest first, usually only few are new
+        changes = []
+        for start, data in fetch_pages(filter_changes_url, count):
+            if 'filter_changes' not in data:
+                # unknown content
+                break
+
+            page = list(data['filter_changes'])
+            for change in page:
+                if change.get('type', filter_type) != filter_type:
+                    continue
+                # (re-applying a change of the same date is harmless)
+                if change['date'] < last_update:
+                    page = [] # caught up
+                    break
+                changes.append({
+                    'spamtext': change['spamtext'],
+                    'is_active': bool(change['is_active']),
+                    'date': change['date'],
+                })
+            if len(page) < count: # all done
+                logger.debug('%s: fetched %d %s filter changes.' % (self.__name__, len(changes), filter_type))
+                changes.reverse()
+                return changes
         return None
 
-def get_filter(filter_type, cachedir):
-    filename = '{1}spamfilter_{0}.json'.format(filter_type, cachedir)
+FILTER_TYPES = ('link', 'thumb', 'tld', 'text', 'user')
+
+def _filter_filename(filter_type, cachedir):
+    return '{1}spamfilter_{0}.json'.format(filter_type, cachedir)
+
+def _sync_marker_filename(cachedir):
+    return '{0}spamfilter_sync.json'.format(cachedir)
+
+def _load_sync_markers(cachedir):
+    """Remote last-update times our cached lists are synced to
 
-    def cache_filters(filter_type):
-        response = sync_rarchives_spamdb(filter_type)
+    (and under 'checked', when each was last found up to date)
+    """
+    try:
+        with open(_sync_marker_filename(cachedir), 'r') as inf:
+            return json.load(inf)
+    except (IOError, OSError, ValueError):
+        return {}
+
+_sync_marker_lock = threading.Lock()
+
+def _save_sync_marker(cachedir, filter_type, last_update):
+    with _sync_marker_lock: # filter types are synced in parallel
+        markers = _load_sync_markers(cachedir)
+        if last_update is None:
+            markers.pop(filter_type, None)
+        else:
+            markers[filter_type] = last_update
+        markers.setdefault('checked', {})[filter_type] = time.time()
+        write_file_atomic(_sync_marker_filename(cachedir),
+                          json.dumps(markers).encode('utf-8'))
+
+def _last_checked(cachedir, filter_type, filename):
+    """When the cached `filter_type` list was last synced or found up to date"""
+    checked = _load_sync_markers(cachedir).get('checked', {}).get(filter_type)
+    if checked is None: # (synced before checks were recorded)
+        checked = os.path.getmtime(filename)
+    return checked
+
+def _load_dataset(filename, filter_type):
+    """Load a cached filter dataset, None if it is missing or inconsistent"""
+    try:
+        with open(filename, 'r') as inf:
+            dataset = json.load(inf)
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        if dataset['type'] != filter_type or \
+                int(dataset['total']) != len(dataset['filters']) or \
+                not all('spamtext' in val for val in dataset['filters']):
+            return None
+    except (KeyError, TypeError, ValueError):
+        return None
+    return dataset
+
+def _patch_dataset(dataset, changes):
+    """Apply filter `changes` (oldest first) to `dataset`"""
+    filters = OrderedDict((val['spamtext'], val) for val in dataset['filters'])
+    added = removed = 0
+    for change in changes:
+        spamtext = change['spamtext']
+        if change['is_active']:
+            if spamtext not in filters:
+                filters[spamtext] = {'spamtext': spamtext}
+                added += 1
+        elif filters.pop(spamtext, None) is not None:
+            removed += 1
+    dataset['filters'] = list(filters.values())
+    dataset['total'] = len(dataset['filters'])
+    return added, removed
+
+def _filter_outdated(filter_type, cachedir):
+    filename = _filter_filename(filter_type, cachedir)
+    return not os.path.isfile(filename) or \
+        (int(time.time() - _last_checked(cachedir, filter_type, filename)) > 43200) # cache 12 hours
+
+_unknown = object()
+
+def update_filter(filter_type, cachedir, last_update=_unknown):
+    """Refresh the cached `filter_type` list if it is outdated
+
+    Patches the cached list with the changes since our last sync,
+    and only re-fetches everything when that isn't possible.
+    `last_update` is rarchives_last_update(), if already known.
+    Returns False if there is no usable cached list afterwards.
+    """
+    filename = _filter_filename(filter_type, cachedir)
+
+    def cache_filters(filter_type, last_update):
+        dataset = _load_dataset(filename, filter_type)
+        synced_to = _load_sync_markers(cachedir).get(filter_type)
+        if dataset and synced_to is not None and last_update is not None:
+            if last_update == synced_to:
+                logger.debug('%s filters are up to date' % filter_type)
+                # (the list file is left alone, it didn't change)
+                _save_sync_marker(cachedir, filter_type, last_update)
+                return
+            changes = sync_rarchives_spamdb(filter_type, last_update=synced_to)
+            if changes is not None:
+                added, removed = _patch_dataset(dataset, changes)
+                logger.info('Patched %s filters: %d added, %d removed' % (filter_type, added, removed))
+                write_file_atomic(filename, json.dumps(dataset).encode('utf-8'))
+                _save_sync_marker(cachedir, filter_type, last_update)
+                return
+            logger.info('Spamfilter delta update failed, fetching full list')
+
+        response = sync_rarchives_spamdb(filter_type, checkpoint=filename + '.part')
         if not response:
             msg = 'Spamfilter update failed, using cached files (if available)'
             logger.warning(msg)
         else:
-            with open(filename, 'wb') as outf:
-                outf.write(response.encode('utf-8'))
-
-    if not os.path.isfile(filename) or \
-            (int(time.time() - os.path.getmtime(filename)) > 43200): # cache 24 hours
-        logger.info('Downloading spambot.rarchives.com list: %s filters' % filter_type)
-        cache_filters(filter_type)
+            write_file_atomic(filename, response.encode('utf-8'))
+            _save_sync_marker(cachedir, filter_type, last_update)
+
+    if _filter_outdated(filter_type, cachedir):
+        logger.info('Updating spambot.rarchives.com list: %s filters' % filter_type)
+        if last_update is _unknown:
+            last_update = rarchives_last_update()
+        cache_filters(filter_type, last_update)
         if not os.path.isfile(filename):
-            errmsg = "Could not load spam filters. Cached files invalid or Network failure."
-            sys.exit(errmsg) # quick&ugly, sorry
+            return False
+    return True
+
+def update_filters(cachedir, concurrency=None, exit_on_error=True):
+    """Refresh all outdated filter lists, `concurrency` at a time
+
+    Returns False if any list is unusable (unless `exit_on_error`).
+    """
+    last_update = _unknown
+    if any(_filter_outdated(filter_type, cachedir) for filter_type in FILTER_TYPES):
+        # (one request for all of them)
+        last_update = rarchives_last_update()
+    pool = ThreadPool(concurrency or len(FILTER_TYPES))
+    try:
+        updated = pool.map(lambda filter_type: update_filter(filter_type, cachedir, last_update),
+                           FILTER_TYPES)
+    finally:
+        pool.close()
+        pool.join()
+    if all(updated):
+        return True
+    if exit_on_error:
+        errmsg = "Could not load spam filters. Cached files invalid or Network failure."
+        sys.exit(errmsg) # quick&ugly, sorry
+    return False
+
+def get_filter(filter_type, cachedir):
+    filename = _filter_filename(filter_type, cachedir)
+    if not update_filter(filter_type, cachedir):
+        errmsg = "Could not load spam filters. Cached files invalid or Network failure."
+        sys.exit(errmsg) # quick&ugly, sorry
 
     filters = None
     try:
@@ -137,109 +502,471 @@ def get_filter(filter_type, cachedir):
     filters = set(val['spamtext'] for val in filters)
     return filters
 
-cachedir = None
+#
+# compiled spamfilter cache
+#
+# Holds the ready-to-use LISTS structures (including the matcher automata),
+# so a (re-)start doesn't have to re-parse and re-compile the json files.
+# Layout: magic, header (format version, signature length, payload crc32),
+#         signature (json), payload (pickled LISTS)
+#
 
-def populate_spamfilter_lists(cache_dir=None):
-    # s.r.c filters
-    global cachedir
-    if not cachedir:
-        if not cache_dir:
-            return
-        cachedir = cache_dir
+COMPILED_MAGIC = b'RIBSPAM\x00'
+COMPILED_VERSION = 5
+_compiled_header = struct.Struct(b'!HII')
 
-    link_filter = get_filter('link', cachedir)
-    link_filter = set(_strip_scheme(link) for link in link_filter)
-    thumb_filter = get_filter('thumb', cachedir)
-    tld_filter = get_filter('tld', cachedir)
-    tld_filter = set(tld.strip('.') for tld in tld_filter)
-    text_filter = get_filter('text', cachedir)
-    user_filter = get_filter('user', cachedir)
+def _compiled_filename(cachedir):
+    return '{0}spamfilter.cache'.format(cachedir)
+
+def _filters_signature(cachedir):
+    """Identify the contents of the cached json files the lists are built from
+
+    (by content, not file times: files rewritten or touched
+     without changes keep their compiled lists)
+    """
+    signature = []
+    for filter_type in FILTER_TYPES:
+        signature.append([filter_type, file_digest(_filter_filename(filter_type, cachedir))])
+    # (link rules are indexed by their public suffix)
+    signature.append(['psl'] + psl_signature(cachedir))
+    signature.append(['prefilter', bool(use_prefilter)])
+    return signature
+
+def save_compiled_lists(cachedir, signature, lists):
+    payload = pickle.dumps(lists, pickle.HIGHEST_PROTOCOL)
+    signature = json.dumps(signature).encode('utf-8')
+    header = _compiled_header.pack(COMPILED_VERSION, len(signature),
+                                   zlib.crc32(payload) & 0xffffffff)
+    write_file_atomic(_compiled_filename(cachedir),
+                      COMPILED_MAGIC + header + signature + payload)
+
+def load_compiled_lists(cachedir, signature):
+    """Load the compiled LISTS, if they match `signature`
+
+    Returns None when the cache is missing, stale or corrupt.
+    """
+    filename = _compiled_filename(cachedir)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'rb') as inf:
+        data = inf.read()
+
+    offset = len(COMPILED_MAGIC)
+    if data[:offset] != COMPILED_MAGIC:
+        logger.warning('Compiled spamfilter cache is corrupt, ignoring it')
+        return None
+    try:
+        version, siglen, crc = _compiled_header.unpack_from(data, offset)
+        offset += _compiled_header.size
+        if version != COMPILED_VERSION:
+            logger.debug('Compiled spamfilter cache has format version %d, ignoring it' % version)
+            return None
+        cached_signature = json.loads(data[offset:offset+siglen].decode('utf-8'))
+        if cached_signature != signature:
+            logger.debug('Compiled spamfilter cache is stale')
+            return None
+        payload = data[offset+siglen:]
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            raise ValueError('checksum mismatch')
+        return pickle.loads(payload)
+    except Exception as e:
+        logger.warning('Compiled spamfilter cache is corrupt, ignoring it (%s)' % e)
+        return None
+
+def build_spamfilter_lists(cachedir, prefilter=False):
+    """Build LISTS from the cached json files"""
+    return compile_spamfilter_lists(dict(
+        (filter_type, get_filter(filter_type, cachedir))
+        for filter_type in FILTER_TYPES), prefilter=prefilter)
+
+def compile_spamfilter_lists(filters, prefilter=False):
+    """Build LISTS from the raw `filters` (sets of spamtext, by filter type)
+
+    With `prefilter`, also the Bloom filter prefilters (see Prefilter).
+    """
+    link_filter = set(_strip_scheme(link) for link in filters['link'])
+    thumb_filter = filters['thumb']
+    tld_filter = set(tld.strip('.') for tld in filters['tld'])
+    text_filter = filters['text']
+    user_filter = filters['user']
 
     blacklist = set()
     whitelist = set('reddit.com')
 
-    global LISTS
-    LISTS = {
-        'link': link_filter,
-        'thumb': thumb_filter,
+    # identifies the list contents (not their files)
+    version = hashlib.sha1()
+    for filters in (link_filter, thumb_filter, tld_filter, text_filter, user_filter):
+        for item in sorted(filters):
+            version.update(item.encode('utf-8') + b'\n')
+        version.update(b'\x00')
+
+    lists = {
+        'version': version.hexdigest(),
+        # substring-matched lists, compiled once for single-pass lookups
+        # (link rules are pre-sorted by the domain they are anchored to)
+        'link': DomainIndex(link_filter),
+        'thumb': DomainIndex(thumb_filter),
         'tld': tld_filter,
-        'text': text_filter,
-        'user': user_filter,
+        'text': Automaton(text_filter),
+        'user': Automaton(user_filter),
         'blacklist': blacklist, # domains
         'whitelist': whitelist, # domains
     }
+    # (for pages of results, see isspam_links/isspam_texts)
+    lists['scanners'] = {
+        'link': PageScanner(lists['link'].residual, lists['thumb'].residual),
+        'text': PageScanner(lists['text'], lists['user']),
+    }
+    if prefilter:
+        lists['prefilter'] = dict((filter_type, Prefilter(lists[filter_type]))
+                                  for filter_type in ('link', 'thumb', 'text', 'user'))
+    return lists
+
+cachedir = None
+verdict_cache = None
+verdict_memo = OrderedDict() # (tag, key) -> reason, in front of verdict_cache
+verdict_memo_size = 20000
+verdict_flush_size = 200 # verdicts written to verdict_cache at once
+_pending_verdicts = {} # key -> (tag, reason), not written yet
+use_prefilter = False
+_sync_concurrency = None
+_signature = None
+
+def _load_spamfilter_lists(cachedir, signature):
+    lists = load_compiled_lists(cachedir, signature)
+    if lists is None:
+        lists = build_spamfilter_lists(cachedir, prefilter=use_prefilter)
+        try:
+            save_compiled_lists(cachedir, signature, lists)
+        except (IOError, OSError) as e:
+            logger.warning('Could not write compiled spamfilter cache: %s' % e)
+    else:
+        logger.debug('Spamfilter lists loaded from compiled cache')
+    return lists
+
+def _swap_spamfilter_lists(lists, signature):
+    global LISTS, _signature, verdict_memo
+    with util.fork_lock: # (from the refresh thread, see util.fork)
+        LISTS = lists # (a single assignment, readers see either version)
+        _signature = signature
+
+        # verdicts from older lists are void
+        verdict_memo = OrderedDict()
+        if verdict_cache is not None:
+            verdict_cache.invalidate(_verdict_tag(lists))
+
+def populate_spamfilter_lists(cache_dir=None, verdict_cache_size=50000,
+                              sync_concurrency=None, prefilter=False):
+    # s.r.c filters
+    global cachedir, use_prefilter
+    use_prefilter = prefilter
+    if not cachedir:
+        if not cache_dir:
+            return
+        cachedir = cache_dir
+    global _sync_concurrency
+    _sync_concurrency = sync_concurrency
+
+    update_filters(cachedir, sync_concurrency)
+
+    global verdict_cache
+    if verdict_cache_size and verdict_cache is None:
+        verdict_cache = SqliteCache('{0}spamfilter_verdicts.sqlite'.format(cachedir),
+                                    maxsize=verdict_cache_size)
+
+    signature = _filters_signature(cachedir)
+    _swap_spamfilter_lists(_load_spamfilter_lists(cachedir, signature), signature)
+
+def refresh_spamfilter_lists():
+    """Re-sync outdated filter lists and swap in new LISTS if they changed
+
+    Unlike populate_spamfilter_lists, never exits: on failure
+    the current lists are kept. Returns True if LISTS were replaced.
+    """
+    if not cachedir:
+        return False
+    try:
+        if not update_filters(cachedir, _sync_concurrency, exit_on_error=False):
+            logger.warning('Spamfilter refresh failed, keeping current lists')
+            return False
+        signature = _filters_signature(cachedir)
+        if signature == _signature:
+            return False
+        lists = _load_spamfilter_lists(cachedir, signature)
+    except (Exception, SystemExit) as e: # (get_filter exits on bad files)
+        logger.warning('Spamfilter refresh failed, keeping current lists (%s)' % e)
+        return False
+    _swap_spamfilter_lists(lists, signature)
+    logger.info('Spamfilter lists reloaded (version %s)' % lists['version'][:12])
+    return True
+
+_refresh_thread = None
+_refresh_stop = threading.Event()
+
+def start_spamfilter_refresh(interval=3600):
+    """Periodically refresh LISTS from a background thread
+
+    Checks every `interval` seconds; lists are only re-synced
+    when outdated (see update_filter), and only rebuilt when changed.
+    """
+    global _refresh_thread
+    if not interval or _refresh_thread is not None:
+        return
+
+    def refresh():
+        while not _refresh_stop.wait(interval):
+            refresh_spamfilter_lists()
+
+    _refresh_stop.clear()
+    _refresh_thread = threading.Thread(target=refresh, name='spamfilter-refresh')
+    _refresh_thread.daemon = True
+    _refresh_thread.start()
+
+def stop_spamfilter_refresh():
+    global _refresh_thread
+    if _refresh_thread is None:
+        return
+    _refresh_stop.set()
+    _refresh_thread = None # (daemonic, not waiting on a running sync)
 
 def spamfilter_lists(cache_dir=None):
     global LISTS
     return LISTS
 
-def isspam_link(url):
-    global LISTS
-
+def _verdict_tag(lists):
+    """What verdicts are valid for: the version of the `lists`,
+    and of the PublicSuffixList (link rules are indexed by domain)"""
+    version = lists.get('version')
+    if not version:
+        return None
+    return '%s:%s' % (version, getattr(util.psl_cached, 'version', None))
+
+def _remember_verdict(tag, key, reason, write=True):
+    memo = verdict_memo
+    memo[(tag, key)] = reason
+    if len(memo) > verdict_memo_size:
+        memo.popitem(last=False)
+    if write:
+        _pending_verdicts[key] = (tag, reason)
+        if len(_pending_verdicts) >= verdict_flush_size:
+            flush_verdicts()
+
+def flush_verdicts():
+    """Write the verdicts not yet in verdict_cache, in one transaction"""
+    global _pending_verdicts
+    pending, _pending_verdicts = _pending_verdicts, {}
+    if verdict_cache is None or not pending:
+        return
+    by_tag = {}
+    for key, (tag, reason) in pending.items():
+        by_tag.setdefault(tag, []).append((key, (reason,)))
+    for tag, verdicts in by_tag.items():
+        verdict_cache.set_many(verdicts, tag=tag)
+
+def _cached_verdict(key, classify, *args):
+    """Spam-check via `classify`, remembering its verdict across processes
+
+    `classify` returns a reason (for logging) if it considers its input spam.
+    It is passed the current LISTS, which may be swapped at any time
+    by a background refresh, so all checks are done against one version.
+    Verdicts are looked up in memory first, then in verdict_cache.
+    New ones are written to it in batches (see flush_verdicts).
+    """
+    lists = LISTS
+    tag = _verdict_tag(lists)
+    if verdict_cache is None or not tag:
+        return classify(lists, *args)
+    reason = verdict_memo.get((tag, key), False)
+    if reason is False:
+        verdict = verdict_cache.get(key, tag=tag)
+        if verdict is None:
+            reason = classify(lists, *args)
+            _remember_verdict(tag, key, reason)
+            return reason
+        reason, = verdict
+        _remember_verdict(tag, key, reason, write=False)
+    if reason:
+        reason += ' (cached)'
+    return reason
+
+def _cached_verdicts(keys, classify_page):
+    """_cached_verdict() for a whole page of `keys` -> items
+
+    Returns {key: reason}.
+    Known verdicts are looked up in one go, the rest are checked
+    together by `classify_page` (see _isspam_link_page) and
+    written to verdict_cache in one transaction.
+    """
+    lists = LISTS
+    tag = _verdict_tag(lists)
+    if verdict_cache is None or not tag:
+        return dict(zip(keys, classify_page(lists, list(keys.values()), list(keys))))
+    reasons = {}
+    missing = []
+    for key in keys:
+        reason = verdict_memo.get((tag, key), False)
+        if reason is False:
+            missing.append(key)
+        else:
+            reasons[key] = reason and reason + ' (cached)'
+    cached = verdict_cache.get_many(missing, tag=tag) if missing else {}
+    todo = []
+    for key in missing:
+        if key in cached:
+            reason, = cached[key]
+            _remember_verdict(tag, key, reason, write=False)
+            reasons[key] = reason and reason + ' (cached)'
+        else:
+            todo.append(key)
+    if todo:
+        checked = classify_page(lists, [keys[key] for key in todo], todo)
+        for key, reason in zip(todo, checked):
+            _remember_verdict(tag, key, reason)
+            reasons[key] = reason
+    flush_verdicts() # (one transaction per page)
+    return reasons
+
+def _isspam_link(lists, url, page=None, stripped=None):
     if len(url) < 6: # shorter than '//a.bc' can't be a useable absolute HTTP URL
-        logger.debug('Skipping invalid URL: "{0}"'.format(url))
-        return True
+        return 'Skipping invalid URL: "{0}"'.format(url)
 
-    url = _strip_scheme(url)
+    url = _strip_scheme(url) if stripped is None else stripped
 
     # domain from URL using publicsuffix (not a validator)
-    domain, fulldomain = domain_suffix(url)
+    if page is None:
+        domain, fulldomain = domain_suffix(url)
+    else:
+        # (batch lookup, one PSL lookup per host)
+        netloc = url_netloc(url)
+        if netloc not in page['hosts']:
+            page['hosts'][netloc] = domain_suffix('//' + netloc)
+        domain, fulldomain = page['hosts'][netloc]
     if not domain:
-        logger.debug('Failed to lookup PSL/Domain for: "{0}"'.format(url))
-        return True
+        return 'Failed to lookup PSL/Domain for: "{0}"'.format(url)
 
     tld = tld_from_suffix(domain)
     if not tld or tld == '':
-        logger.debug('Failed to lookup TLD from publicsuffix for: "{0}"'.format(url))
-        return True
+        return 'Failed to lookup TLD from publicsuffix for: "{0}"'.format(url)
 
-    if domain in LISTS['whitelist']:
+    if domain in lists['whitelist']:
         # higher prio than the blacklist
-        return False
+        return None
 
-    if domain in LISTS['blacklist']:
-        logger.debug('Skipping blacklisted Domain "{0}": {1}'.format(domain, url))
-        return True
+    if domain in lists['blacklist']:
+        return 'Skipping blacklisted Domain "{0}": {1}'.format(domain, url)
 
-    if tld in LISTS['tld']:
-        logger.debug('Skipping blacklisted TLD "{0}": {1}'.format(tld, url))
-        return True
+    if tld in lists['tld']:
+        return 'Skipping blacklisted TLD "{0}": {1}'.format(tld, url)
 
-    inlist = _check(url, LISTS['link']) # perfect match (100% certainty)
-    if inlist:
-        logger.debug('Skipping spammy link match "{0}": {1}'.format(inlist, url))
-        return True
-    inlist = _check(fulldomain, LISTS['link']) # full match (~80% certainty)
+    # (fulldomain is part of url, domain is not if the host isn't lowercase)
+    prefilter = use_prefilter and lists.get('prefilter')
+    if prefilter:
+        strings = (url,) if domain in url else (url, domain)
+        if not any(prefilter['link'].may_match(string, domain) for string in strings) and \
+                not prefilter['thumb'].may_match(url, domain):
+            return None
+
+    if page is None:
+        page = {'link': {}, 'thumb': {}, 'hosts': {}, 'checked': {}}
+
+    inlist = _check(url, lists['link'], domain, page['link'].get(url)) # perfect match (100% certainty)
     if inlist:
-        logger.debug('Skipping spammy link match "{0}": {1}'.format(inlist, fulldomain))
-        return True
-    inlist = _check(domain, LISTS['link']) # partial match (~50% certainty)
+        return 'Skipping spammy link match "{0}": {1}'.format(inlist, url)
+    # (no full match (~80% certainty) on fulldomain, it is part of url)
+    if domain not in page['checked']: # (the same for every link to this domain)
+        page['checked'][domain] = _check(domain, lists['link'], domain)
+    inlist = page['checked'][domain] # partial match (~50% certainty)
     if inlist:
-        logger.debug('Skipping spammy link match "{0}": {1}'.format(inlist, domain))
-        return True
+        return 'Skipping spammy link match "{0}": {1}'.format(inlist, domain)
 
-    inlist = _check(url, LISTS['thumb'])
+    inlist = _check(url, lists['thumb'], domain, page['thumb'].get(url))
     if inlist:
-        logger.debug('Skipping spammy thumb match "{0}": {1}'.format(inlist, url))
-        return True
+        return 'Skipping spammy thumb match "{0}": {1}'.format(inlist, url)
 
     # no spam, result is good
-    return False
+    return None
 
-def isspam_text(text):
-    """check search result for spammy content
+def _isspam_link_page(lists, urls, keys):
+    """_isspam_link() for all `urls` of a page at once
+
+    Each link is scanned for link and thumb rules in one pass,
+    domain lookups and checks are shared between the links.
     """
-    global LISTS
+    page = {'link': {}, 'thumb': {}, 'hosts': {}, 'checked': {}}
+    stripped = [key[len('link:'):] for key in keys]
+    if 'scanners' in lists and not (use_prefilter and lists.get('prefilter')):
+        # (with the prefilter, most links need no pass at all)
+        page['link'], page['thumb'] = lists['scanners']['link'].scan(stripped)
+    return [_isspam_link(lists, url, page, string) for url, string in zip(urls, stripped)]
 
-    inlist = _check(text, LISTS['text'])
-    if inlist:
-        logger.debug('Skipping spammy text match "{0}": "{1}"'.format(inlist, text))
+def isspam_link(url):
+    reason = _cached_verdict('link:' + _strip_scheme(url), _isspam_link, url)
+    if reason:
+        logger.debug(reason)
         return True
+    return False
+
+def _isspam_text(lists, text, page=None):
+    prefilter = use_prefilter and lists.get('prefilter')
+    if prefilter and not prefilter['text'].may_match(text) and \
+            not prefilter['user'].may_match(text):
+        return None
 
-    inlist = _check(text, LISTS['user'])
+    if page is None:
+        page = {'text': {}, 'user': {}}
+
+    inlist = _check(text, lists['text'], matched=page['text'].get(text))
     if inlist:
-        logger.debug('Skipping spammy user match "{0}": "{1}"'.format(inlist, text))
-        return True
+        return 'Skipping spammy text match "{0}": "{1}"'.format(inlist, text)
+
+    inlist = _check(text, lists['user'], matched=page['user'].get(text))
+    if inlist:
+        return 'Skipping spammy user match "{0}": "{1}"'.format(inlist, text)
 
     # no spam, result is good
+    return None
+
+def _isspam_text_page(lists, texts, keys):
+    """_isspam_text() for all `texts` of a page, one automaton pass each"""
+    page = {'text': {}, 'user': {}}
+    if 'scanners' in lists and not (use_prefilter and lists.get('prefilter')):
+        page['text'], page['user'] = lists['scanners']['text'].scan(texts)
+    return [_isspam_text(lists, text, page) for text in texts]
+
+def isspam_text(text):
+    """check search result for spammy content
+    """
+    reason = _cached_verdict('text:' + text, _isspam_text, text)
+    if reason:
+        logger.debug(reason)
+        return True
     return False
+
+def _classify_batch(items, prefix, classify_page):
+    # (duplicates within a batch are only checked once)
+    keys = OrderedDict() # key -> item
+    item_keys = []
+    for item in items:
+        key = item and prefix + (_strip_scheme(item) if prefix == 'link:' else item)
+        if key:
+            keys.setdefault(key, item)
+        item_keys.append(key)
+    reasons = _cached_verdicts(keys, classify_page)
+    for reason in reasons.values():
+        if reason:
+            logger.debug(reason)
+    return [(bool(reasons.get(key)), reasons.get(key)) for key in item_keys]
+
+def isspam_links(urls):
+    """check many links at once
+
+    Returns an `(isspam, reason)` tuple for every url, in order.
+    """
+    return _classify_batch(urls, 'link:', _isspam_link_page)
+
+def isspam_texts(texts):
+    """check many search result texts at once
+
+    Returns an `(isspam, reason)` tuple for every text, in order.
+    """
+    return _classify_batch(texts, 'text:', _isspam_text_page)
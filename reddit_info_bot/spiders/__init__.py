@@ -3,35 +3,39 @@ from __future__ import print_function
 
 import sys
 import time
-import json
+import heapq
 import logging
+import itertools
 from functools import partial
 
-try:
-    # remove any already installed reactor
-    del sys.modules['twisted.internet.reactor']
-except KeyError: pass
-# reinstall reactor
-from twisted.internet.default import install
-#from twisted.internet.pollreactor import install
-#from twisted.internet.epollreactor import install
-install()
-del install
+if not getattr(sys.modules.get('twisted.internet.reactor'), 'forksafe', False):
+    # (keep a reactor pre-installed for forking, see serve_forked_searches)
+    try:
+        # remove any already installed reactor
+        del sys.modules['twisted.internet.reactor']
+    except KeyError: pass
+    # reinstall reactor
+    from twisted.internet.default import install
+    #from twisted.internet.pollreactor import install
+    #from twisted.internet.epollreactor import install
+    install()
+    del install
 
 from twisted.internet import reactor
-from twisted.internet.error import TimeoutError
+from twisted.internet.error import TimeoutError, ConnectError
 
 # apply monkey patches for scrapy
 from . import _monkeypatches
 del _monkeypatches
 
 from scrapy.spiders import Spider
-from scrapy.exceptions import CloseSpider
+from scrapy.exceptions import CloseSpider, DontCloseSpider
 from scrapy.settings import Settings
 
 from scrapy.http import Request
-from ..spamfilter import isspam_link, isspam_text
-from ..util import http_code_ranges
+from ..spamfilter import isspam_link, isspam_text, isspam_links, isspam_texts, flush_verdicts
+from ..util import http_code_ranges, fork
+from ..channel import FrameWriter, FrameReader
 
 logger = logging.getLogger(__name__)
 
@@ -142,39 +146,251 @@ class RetryMiddleware(ScrapyRetryMiddleware):
         return response
 
 
+# LinkCheckMiddleware, checking each result link once per search
+from twisted.internet.defer import Deferred, succeed
+from twisted.python.failure import Failure
+from scrapy.http import Response
+from ..cache import SqliteCache
+
+linkchecks = {} # (search job, method, url) -> LinkCheck
+linkcheck_cache = None
+
+class DeadHostError(TimeoutError):
+    """Link-check skipped, the host failed to answer recently"""
+
+def open_linkcheck_cache(settings):
+    """Link-check outcomes kept across searches (if enabled)"""
+    global linkcheck_cache
+    size = settings.getint('LINKCHECK_CACHE_SIZE')
+    if linkcheck_cache is None and size:
+        linkcheck_cache = SqliteCache('{0}linkcheck.sqlite'.format(settings.get('_CACHEDIR_', '')),
+                                      maxsize=size)
+    return linkcheck_cache
+
+class LinkCheck(object):
+    """A link-check download, and the requests waiting for its outcome"""
+
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url # (as first requested, redirects may change it)
+        self.outcome = None # Response or Failure
+        self.waiters = []
+
+    def wait(self, request):
+        if self.outcome is not None:
+            return self._deliver(request)
+        d = Deferred()
+        timeout = float(request.meta.get('download_timeout', 180))
+        call = reactor.callLater(timeout, self._timeout, request, d)
+        self.waiters.append((request, d, call))
+        return d
+
+    def _timeout(self, request, d):
+        self.waiters = [w for w in self.waiters if w[1] is not d]
+        d.errback(TimeoutError('Shared link-check of %s took longer than %.1fs' % (
+            request.url, float(request.meta.get('download_timeout', 180)))))
+
+    def _deliver(self, request):
+        if isinstance(self.outcome, Failure):
+            return self.outcome
+        return self.outcome.replace(request=request)
+
+    def resolve(self, outcome):
+        if self.outcome is not None:
+            return
+        if isinstance(outcome, Response):
+            # (only status and headers are checked)
+            outcome = outcome.replace(body=b'', flags=(outcome.flags or []) + ['shared'])
+        self.outcome = outcome
+        waiters, self.waiters = self.waiters, []
+        for request, d, call in waiters:
+            call.cancel()
+            result = self._deliver(request)
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+class LinkCheckMiddleware(object):
+    """Check each link once per search, and remember the outcome
+
+    The same URL is often found by several search providers,
+    and then link-checked in each of their spiders. Link-check
+    requests (meta 'linkcheck') for a URL already being checked,
+    in any spider of the same search, wait for that check and
+    are given its response (or error) instead.
+
+    Outcomes are cached across searches (status and final URL),
+    good ones for LINKCHECK_CACHE_TTL, broken ones for
+    LINKCHECK_CACHE_BROKEN_TTL seconds. Hosts which timed out or
+    refused connections LINKCHECK_HOST_FAILURES times in a row
+    are not checked again for LINKCHECK_HOST_FAILURE_TTL seconds.
+    """
+
+    host_errors = (TimeoutError, ConnectError)
+    cached_headers = ('Content-Type', 'Content-Length', 'Content-Range')
+
+    def __init__(self, stats, cache=None, ttl=0, broken_ttl=0,
+                 host_failures=0, host_failure_ttl=0):
+        self.stats = stats
+        self.cache = cache
+        self.ttl = ttl
+        self.broken_ttl = broken_ttl
+        self.host_failures = host_failures
+        self.host_failure_ttl = host_failure_ttl
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(crawler.stats, open_linkcheck_cache(settings),
+                   ttl=settings.getint('LINKCHECK_CACHE_TTL'),
+                   broken_ttl=settings.getint('LINKCHECK_CACHE_BROKEN_TTL'),
+                   host_failures=settings.getint('LINKCHECK_HOST_FAILURES'),
+                   host_failure_ttl=settings.getint('LINKCHECK_HOST_FAILURE_TTL'))
+
+    def process_request(self, request, spider):
+        if not request.meta.get('linkcheck') or 'linkcheck_owner' in request.meta:
+            return # (retries and redirects of a check pass)
+        if self.cache is not None:
+            if self._host_failing(request):
+                self.stats.inc_value('linkcheck/host_skipped', spider=spider)
+                request.meta['dont_retry'] = True
+                raise DeadHostError('%s failed to answer recently' % urlsplit(request.url).netloc)
+            response = self._cached(request)
+            if response is not None:
+                self.stats.inc_value('linkcheck/cache_hit', spider=spider)
+                request.meta['dont_retry'] = True
+                return response
+            self.stats.inc_value('linkcheck/cache_miss', spider=spider)
+
+        key = (getattr(spider, 'search_job', None), request.method, request.url)
+        check = linkchecks.get(key)
+        if check is None:
+            linkchecks[key] = request.meta['linkcheck_owner'] = LinkCheck(request.method, request.url)
+            self.stats.inc_value('linkcheck/checked', spider=spider)
+            return
+        self.stats.inc_value('linkcheck/shared', spider=spider)
+        request.meta['dont_retry'] = True # (the check was retried already)
+        return check.wait(request)
+
+    def process_response(self, request, response, spider):
+        check = request.meta.get('linkcheck_owner')
+        if check is not None and check.outcome is None:
+            check.resolve(response)
+            self._remember(check, response)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        check = request.meta.get('linkcheck_owner')
+        if check is not None and check.outcome is None:
+            check.resolve(Failure(exception))
+            if isinstance(exception, self.host_errors):
+                self._host_failed(check)
+
+    # cache
+
+    def _cached(self, request):
+        outcome = self.cache.get('link:%s %s' % (request.method, request.url))
+        if outcome is None:
+            return None
+        status, url, checked = outcome[:3]
+        headers = outcome[3] if len(outcome) > 3 else None
+        ttl = self.ttl if status in (200, 206) else self.broken_ttl
+        if time.time() - checked > ttl:
+            return None
+        return Response(url, status=status, headers=headers, request=request, flags=['cached'])
+
+    def _remember(self, check, response):
+        if self.cache is None:
+            return
+        headers = dict((name, response.headers.getlist(name)) for name in self.cached_headers
+                       if name in response.headers)
+        self.cache.set('link:%s %s' % (check.method, check.url),
+                       (response.status, response.url, time.time(), headers))
+        self.cache.delete('host:%s' % urlsplit(check.url).netloc)
+
+    def _host_failing(self, request):
+        if not self.host_failures:
+            return False
+        failures = self.cache.get('host:%s' % urlsplit(request.url).netloc,
+                                  maxage=self.host_failure_ttl)
+        return failures is not None and failures >= self.host_failures
+
+    def _host_failed(self, check):
+        if self.cache is None or not self.host_failures:
+            return
+        key = 'host:%s' % urlsplit(check.url).netloc
+        self.cache.set(key, (self.cache.get(key, maxage=self.host_failure_ttl) or 0) + 1)
+
+
 # ItemPipeline
 writer = None
-def collector_pipeline_writer(writefd=None):
+def collector_pipeline_writer(writefd=None, serializer='marshal'):
+    """The search channel writer (set up with `writefd` file object)"""
     global writer
-    if not writer:
-        if not writefd:
-            return
-        writer = writefd
+    if writefd is not None:
+        writer = FrameWriter(writefd, serializer)
     return writer
 
+def write_control(message, **data):
+    """Send a control message (not a result) to the search parent
+
+    (Any results still buffered are sent before it.)
+    """
+    data['_control'] = message
+    return collector_pipeline_writer().write(data, flush=True)
+
 class ResultCollectorPipeline(object):
+    """Send results to the search parent
+
+    They are written in batches, at most `flush_interval` seconds apart.
+    """
 
-    def __init__(self, writer):
+    def __init__(self, writer, flush_interval=0):
         if not writer:
             raise NotConfigured
         self.writer = writer
+        self.flush_interval = flush_interval
+        self.flush_call = None
 
     @classmethod
     def from_settings(cls, settings):
-        o = cls(collector_pipeline_writer())
+        o = cls(collector_pipeline_writer(),
+                settings.getfloat('SEARCH_CHANNEL_FLUSH_INTERVAL'))
         return o
 
     def process_item(self, item, spider):
-        """ basic 'line writer' protocol, end line with LF """
-        data = json.dumps(dict(item))
-        self.writer.write(data)
-        self.writer.write('\n')
+        data = dict(item)
+        data['_job'] = getattr(spider, 'search_job', None)
+        self.writer.write(data, flush=not self.flush_interval)
+        if self.writer.pending and self.flush_call is None:
+            self.flush_call = reactor.callLater(self.flush_interval, self.flush)
+        return item
+
+    def flush(self):
+        self.flush_call = None
         self.writer.flush()
 
-        return item
+    def close_spider(self, spider):
+        if self.flush_call is not None:
+            self.flush_call.cancel()
+        self.flush()
 
 class InfoBotSpider(Spider):
 
+    @classmethod
+    def update_settings(cls, settings):
+        super(InfoBotSpider, cls).update_settings(settings)
+        # this search engine's throttling profile (see SearchThrottle)
+        profile = settings.getdict('SEARCH_ENGINE_PROFILES').get(cls.__name__)
+        if profile:
+            settings.setdict(profile, priority='spider')
+        # room for link-checks, and for the search engine next to them
+        linkchecks = settings.getint('LINKCHECK_CONCURRENCY')
+        if linkchecks:
+            settings.set('CONCURRENT_REQUESTS', linkchecks + settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN'),
+                         priority='spider')
+
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
         o = super(InfoBotSpider, cls).from_crawler(crawler, *args, **kwargs)
@@ -184,12 +400,27 @@ class InfoBotSpider(Spider):
         o.REDIR_HTTP_CODES = set(o.crawler.settings.getlist('REDIR_HTTP_CODES')) or codes['300']
         o.RETRY_HTTP_CODES = set(o.crawler.settings.getlist('RETRY_HTTP_CODES', [408, 500, 502, 503, 504]))
         o.ERROR_HTTP_CODES = set(o.crawler.settings.getlist('ERROR_HTTP_CODES')) or (codes['400'] | codes['500'] | codes['EXT']) - o.RETRY_HTTP_CODES
+        o.BAN_HTTP_CODES = set(o.crawler.settings.getlist('BAN_HTTP_CODES', [403, 429]))
 
         o.LINKCHECK_TIMEOUT = o.crawler.settings.get('DOWNLOAD_TIMEOUT_LINKCHECK', o.crawler.settings.get('DOWNLOAD_TIMEOUT'))
+        o.LINKCHECK_MAX_BYTES = o.crawler.settings.getint('LINKCHECK_MAX_BYTES')
+
+        # link-check no more results than needed, see parse_result
+        o.LINKCHECK_CONCURRENCY = o.crawler.settings.getint('LINKCHECK_CONCURRENCY')
+        margin = o.crawler.settings.getint('LINKCHECK_MARGIN')
+        o.linkcheck_limit = None
+        if margin >= 0 and getattr(o, 'num_results', None):
+            o.linkcheck_limit = (int(o.num_results), margin)
+        o.linkcheck_queue = [] # heap of (rank, seq, result)
+        o.linkcheck_seq = itertools.count()
+        o.linkchecks_running = 0
+        o.linkchecks_good = 0
+        crawler.signals.connect(o.linkcheck_idle, signal=signals.spider_idle)
         return o
 
     @staticmethod
     def close(spider, reason):
+        flush_verdicts() # (spam-check verdicts not yet shared)
         finished = getattr(spider, 'finished', None)
         if callable(finished):
             finished()
@@ -197,6 +428,14 @@ class InfoBotSpider(Spider):
         if callable(closed):
             return closed(reason)
 
+    def search_failed(self, kind, message):
+        """Note that the search engine failed us, `kind` e.g. 'banned'
+
+        (It counts against the engine's circuit breaker, see ..health)
+        """
+        self.logger.error(message)
+        self.crawler.stats.inc_value('search/failed/%s' % kind)
+
     def debug(self, response):
         from scrapy.shell import inspect_response
         inspect_response(response, self)
@@ -216,66 +455,491 @@ class InfoBotSpider(Spider):
             return False
         return isspam_text(text.lower())
 
+    spam_fields = ('url', 'title', 'description', 'image_url')
+    link_fields = ('url', 'image_url')
+
+    def classify_results(self, results, fields=None):
+        """mark probable spam in a page of search results
+
+        Checks all `fields` of all results in one batch, the first
+        spammy field (in order) is noted as result['spam'].
+        Returns the number of results not marked as spam.
+        """
+        fields = fields or self.spam_fields
+        links = [f for f in fields if f in self.link_fields]
+        texts = [f for f in fields if f not in self.link_fields]
+        values = lambda field: [(r.get(field) or '').lower() for r in results]
+        verdicts = {}
+        if links:
+            checked = iter(isspam_links([v for f in links for v in values(f)]))
+            for field in links:
+                verdicts[field] = [next(checked)[0] for r in results]
+        if texts:
+            checked = iter(isspam_texts([v for f in texts for v in values(f)]))
+            for field in texts:
+                verdicts[field] = [next(checked)[0] for r in results]
+
+        good = 0
+        for i, result in enumerate(results):
+            for field in fields:
+                if verdicts[field][i]:
+                    result['spam'] = field
+                    break
+            else:
+                good += 1
+        return good
+
     # result item returned by search
     def parse_result(self, result):
+        """Link-check `result`, or queue it to be checked when needed
+
+        With a result limit (num_results) only that many results, plus
+        LINKCHECK_MARGIN, are link-checked at first, in the order the
+        search engine ranked them. Others are checked as earlier ones
+        turn out broken. Spam isn't checked at all, it's not shown.
+        No more than LINKCHECK_CONCURRENCY checks run at once.
+        Returns the result, its link-check request, or None if queued.
+        """
         if not 'url' in result or not result['url']:
             # investigate unusable results, that shouldn't happen.
             self.logger.warning("bad result (no URL): %r" % result)
             return
 
+        if self.linkcheck_limit and result.get('spam'):
+            return result
+        heapq.heappush(self.linkcheck_queue,
+                       (result.get('id') or 0, next(self.linkcheck_seq), result))
+        # (only ever one, nothing stays queued while checks can be started)
+        requests = self.next_linkchecks()
+        return requests[0] if requests else None
+
+    def next_linkchecks(self):
+        """Link-check requests for the best-ranked queued results"""
+        wanted = len(self.linkcheck_queue)
+        if self.LINKCHECK_CONCURRENCY:
+            wanted = min(wanted, self.LINKCHECK_CONCURRENCY - self.linkchecks_running)
+        if self.linkcheck_limit:
+            limit, margin = self.linkcheck_limit
+            if self.linkchecks_good >= limit:
+                return []
+            wanted = min(wanted, limit + margin - self.linkchecks_good - self.linkchecks_running)
+        requests = []
+        while self.linkcheck_queue and len(requests) < wanted:
+            _, _, result = heapq.heappop(self.linkcheck_queue)
+            requests.append(self.linkcheck_result(result))
+        self.linkchecks_running += len(requests)
+        return requests
+
+    def linkcheck_done(self, result):
+        """`result` was link-checked, returns it and any checks to follow up with"""
+        self.linkchecks_running -= 1
+        if not result.get('broken'):
+            self.linkchecks_good += 1
+        return [result] + self.next_linkchecks()
+
+    def linkcheck_idle(self, spider):
+        """Nothing left to do: check more queued results, if still needed
+
+        Queued results which weren't needed are passed on unchecked
+        (they count for the search stats, but aren't shown).
+        """
+        if spider is not self or not self.linkcheck_queue:
+            return
+        self.linkchecks_running = 0 # (none can be, when idle)
+        requests = self.next_linkchecks()
+        if requests:
+            for request in requests:
+                self.crawler.engine.crawl(request, self)
+            raise DontCloseSpider
+        self.crawler.stats.inc_value('linkcheck/unchecked', len(self.linkcheck_queue))
+        while self.linkcheck_queue:
+            _, _, result = heapq.heappop(self.linkcheck_queue)
+            result['unchecked'] = True
+            self.crawler.engine.scraper.itemproc.process_item(result, self)
+
+    def linkcheck_result(self, result):
         #
         # link-check, ignore broken/dead link results
         #
 
+        if result['image_url']:
+            # If we have an image_url, check the direct link.
+            # It's more important to us than the page it was found on.
+            return self.linkcheck_request(result, result['image_url'], 'HEAD')
+        return self.linkcheck_request(result, result['url'], 'GET')
+
+    def linkcheck_request(self, result, url, method='HEAD'):
+        """Request checking `url` of `result`
+
+        GET requests ask for the first LINKCHECK_MAX_BYTES only,
+        and never read more than that (see LinkCheckDownloadHandler).
+        """
+
         def _onerror(result, failure):
-            """ handle TimeoutError tracebacks getting dumped to stderr """
-            exc = failure.trap(TimeoutError) # any other exception gets re-raised right here
+            """ any failure (timeouts, refused connections, DNS errors,
+            lost connections, 5xx after retries...) means a broken link
+            """
+            # (never re-raised: linkcheck_done must run for every check)
             errmsg = failure.getErrorMessage()
             self.logger.debug(
                 "Ignoring %s result with %s: %s (%s)" % (
-                    result['provider'], str(exc.__name__), result['url'], errmsg))
+                    result['provider'], failure.type.__name__, result['url'], errmsg))
             result['broken'] = True
-            return result
-
-        url = result['url']
-        reqmethod = 'GET'
-        if result['image_url']:
-            # If we have an image_url, check the direct link.
-            # It's more important to us than the page it was found on.
-            url = result['image_url']
-            reqmethod = 'HEAD' # save on download size
-        return Request(url, method=reqmethod, callback=self.analyze_result,
-            #dont_filter=True,
-            meta={
-                'result': result,
-                #'handle_httpstatus_all': True,
-                'handle_httpstatus_list': list(self.GOOD_HTTP_CODES | self.ERROR_HTTP_CODES),
-                'download_timeout': self.LINKCHECK_TIMEOUT,
-            }, errback=partial(_onerror, result))
+            return self.linkcheck_done(result)
+
+        meta = {
+            'result': result,
+            'linkcheck': True,
+            #'handle_httpstatus_all': True,
+            'handle_httpstatus_list': list(self.GOOD_HTTP_CODES | self.ERROR_HTTP_CODES),
+            'download_timeout': self.LINKCHECK_TIMEOUT,
+        }
+        headers = {}
+        if method == 'GET' and self.LINKCHECK_MAX_BYTES:
+            meta['linkcheck_maxbytes'] = self.LINKCHECK_MAX_BYTES
+            headers = {
+                'Range': 'bytes=0-%d' % (self.LINKCHECK_MAX_BYTES - 1),
+                'Accept-Encoding': 'identity', # (a cut-off body can't be decompressed)
+            }
+        # (duplicate links are checked once, see LinkCheckMiddleware)
+        return Request(url, method=method, headers=headers, callback=self.analyze_result,
+            dont_filter=True, meta=meta, errback=partial(_onerror, result),
+            priority=-(result.get('id') or 0)) # (in rank order)
 
     def analyze_result(self, response):
         result = response.meta['result']
 
-        if response.status == 405 and response.request.method == 'HEAD':
-            # "Method not allowed" - retry as GET
+        if response.status in (405, 501) and response.request.method == 'HEAD':
+            # "Method not allowed" - check with a (short) GET instead
             url = result['url']
             if result['image_url']:
                 url = result['image_url']
-            # consider valid for now
-            # FIXME: retry as GET request
-            return result
+            return self.linkcheck_request(result, url, 'GET')
+
+        content_type = response.headers.get('Content-Type')
+        if content_type:
+            result['content_type'] = content_type.decode('latin1').split(';')[0].strip()
+        result['content_length'] = content_length(response)
 
-        if response.status != 200:
+        # (a partial answer to a range request is fine, as is
+        #  a range too long for a short (or empty) resource)
+        if response.status not in (200, 206, 416):
             self.logger.debug(
                 "Ignoring %s result with bad response status (%s): %s" % (
                     result['provider'], response.status, response.url))
             result['broken'] = True
             #return
 
-        return result
+        return self.linkcheck_done(result)
 
+def content_length(response):
+    """Length of the resource `response` is for, if known
 
-def crawler_setup(settings, *args, **kwargs):
+    (Only part of the body may have been requested, or read.)
+    """
+    content_range = response.headers.get('Content-Range')
+    if response.status == 206 and content_range:
+        total = content_range.rsplit(b'/', 1)[-1].strip()
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('Content-Length')
+    if length and length.strip().isdigit():
+        return int(length)
+    if not response.flags and response.request.method != 'HEAD':
+        return len(response.body) # (all of it)
+    return None
+
+
+# LinkCheckDownloadHandler, reading no more of a link-check response than needed
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler, ScrapyAgent
+from twisted.internet.protocol import Protocol
+from twisted.web.client import ResponseDone, PotentialDataLoss
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+class _TruncatingBodyReader(Protocol):
+    """Read the start of a response body, then drop the connection"""
+
+    def __init__(self, finished, txresponse, maxbytes):
+        self.finished = finished
+        self.txresponse = txresponse
+        self.maxbytes = maxbytes
+        self.body = []
+        self.size = 0
+
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        self.body.append(data)
+        self.size += len(data)
+        if self.size >= self.maxbytes:
+            body = b''.join(self.body)[:self.maxbytes]
+            self.finished.callback((self.txresponse, body, ['truncated']))
+            self.transport.stopProducing() # (closes the connection)
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        body = b''.join(self.body)
+        if reason.check(ResponseDone):
+            self.finished.callback((self.txresponse, body, None))
+        elif reason.check(PotentialDataLoss):
+            self.finished.callback((self.txresponse, body, ['partial']))
+        else:
+            self.finished.errback(reason)
+
+class LinkCheckAgent(ScrapyAgent):
+
+    def _cb_bodyready(self, txresponse, request):
+        maxbytes = request.meta.get('linkcheck_maxbytes')
+        if not maxbytes or txresponse.length == 0:
+            return super(LinkCheckAgent, self)._cb_bodyready(txresponse, request)
+
+        # (twisted keeps it from the headers, a cut-off body won't tell)
+        if txresponse.length != UNKNOWN_LENGTH and not txresponse.headers.hasHeader(b'Content-Length'):
+            txresponse.headers.setRawHeaders(b'Content-Length', [str(txresponse.length).encode('ascii')])
+
+        reader = _TruncatingBodyReader(None, txresponse, maxbytes)
+        reader.finished = d = Deferred(lambda _: reader.transport.stopProducing())
+        txresponse.deliverBody(reader)
+        # save response for timeouts
+        self._txresponse = txresponse
+        return d
+
+shared_pool = None # (connection pool of all crawlers, see serve_search_jobs)
+
+class LinkCheckDownloadHandler(HTTP11DownloadHandler):
+    """HTTP(S) download handler which cuts off link-check responses
+
+    Requests with a 'linkcheck_maxbytes' meta key get a response
+    with at most that many bytes of body (flagged 'truncated' if there
+    was more), the connection is closed once they arrived.
+    Anything else is downloaded as usual.
+
+    With the '_SHARED_HTTP_POOL_' setting, all handlers use one
+    persistent connection pool, kept open when their crawler closes,
+    so connections (and TLS sessions) are reused across searches.
+    """
+
+    def __init__(self, settings):
+        super(LinkCheckDownloadHandler, self).__init__(settings)
+        self._shared = settings.getbool('_SHARED_HTTP_POOL_')
+        if self._shared:
+            global shared_pool
+            if shared_pool is None:
+                shared_pool = self._pool
+            # (per-engine CONCURRENT_REQUESTS_PER_DOMAIN, keep enough for any)
+            shared_pool.maxPersistentPerHost = max(shared_pool.maxPersistentPerHost,
+                                                   self._pool.maxPersistentPerHost)
+            self._pool = shared_pool
+
+    def close(self):
+        if self._shared:
+            return succeed(None) # (the connections outlive the crawler)
+        return super(LinkCheckDownloadHandler, self).close()
+
+    def download_request(self, request, spider):
+        if not request.meta.get('linkcheck_maxbytes'):
+            return super(LinkCheckDownloadHandler, self).download_request(request, spider)
+        agent = LinkCheckAgent(
+            contextFactory=self._contextFactory,
+            pool=self._pool,
+            maxsize=getattr(spider, 'download_maxsize', self._default_maxsize),
+            warnsize=getattr(spider, 'download_warnsize', self._default_warnsize),
+            fail_on_dataloss=self._fail_on_dataloss,
+        )
+        return agent.download_request(request)
+
+
+# Extension
+from scrapy import signals
+from scrapy.core.downloader import Slot
+from scrapy.utils.httpobj import urlparse_cached
+
+search_job = {'started': None, 'reported': True}
+
+def start_search_job(started=None):
+    search_job.update(started=started or time.time(), reported=False)
+    linkchecks.clear()
+
+class SearchProgress(object):
+    """Report search progress to the search parent
+
+    The time from search start to its first request, spider errors,
+    and each provider (spider) as it finishes, with its stats.
+    Also closes spiders at their search deadline (reason 'deadline'),
+    no download may take longer than that.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.deadline = None
+        self.expire_call = None
+        self.opened = None
+        self.items = 0
+        self.errors = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = cls(crawler)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(o.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(o.spider_error, signal=signals.spider_error)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def spider_opened(self, spider):
+        self.opened = time.time()
+        from ..search import search_deadlines
+        deadlines = search_deadlines(self.crawler.settings, search_job['started'] or time.time())
+        self.deadline = deadlines.get(spider.__class__.__name__)
+        if self.deadline is not None:
+            self.expire_call = reactor.callLater(max(self.deadline - time.time(), 0),
+                                                 self.expire, spider)
+
+    def expire(self, spider):
+        self.expire_call = None
+        logger.info('%s search deadline passed, closing spider' % spider.__class__.__name__)
+        self.crawler.engine.close_spider(spider, 'deadline')
+
+    def request_scheduled(self, request, spider):
+        if self.deadline is not None:
+            timeout = float(request.meta.get('download_timeout',
+                                             self.crawler.settings.getfloat('DOWNLOAD_TIMEOUT')))
+            request.meta['download_timeout'] = max(min(timeout, self.deadline - time.time()), 1)
+
+        if search_job['reported']:
+            return
+        search_job['reported'] = True
+        write_control('first_request', latency=time.time() - search_job['started'],
+                      provider=spider.__class__.__name__,
+                      job=getattr(spider, 'search_job', None))
+
+    def item_scraped(self, item, response, spider):
+        self.items += 1
+
+    def spider_error(self, failure, response, spider):
+        self.errors += 1
+        write_control('error', provider=spider.__class__.__name__,
+                      error=failure.getErrorMessage(), url=getattr(response, 'url', None),
+                      job=getattr(spider, 'search_job', None))
+
+    def spider_closed(self, spider, reason):
+        if self.expire_call is not None:
+            self.expire_call.cancel()
+            self.expire_call = None
+        provider = spider.__class__.__name__
+        job = getattr(spider, 'search_job', None)
+        stats = dict((key, value) for key, value in self.crawler.stats.get_stats().items()
+                     if isinstance(value, (int, float)))
+        stats.update(items=self.items, errors=self.errors,
+                     elapsed=time.time() - (self.opened or time.time()))
+        write_control('stats', provider=provider, stats=stats, job=job)
+        write_control('finished', provider=provider, reason=reason, job=job)
+
+# engine download delays at the end of the last search (in a persistent worker)
+engine_delays = {}
+
+class SearchThrottle(object):
+    """Throttle search engine and link-check requests separately
+
+    Each search engine's requests share one download slot, throttled
+    as set up in its SEARCH_ENGINE_PROFILES entry (CONCURRENT_REQUESTS_PER_DOMAIN,
+    DOWNLOAD_DELAY, AUTOTHROTTLE_TARGET_CONCURRENCY, ...). Whenever the
+    engine answers with a ban status, its delay is doubled; a persistent
+    search worker starts the next search with the delay the last ended with.
+    Link-checks go to one slot per host (LINKCHECK_CONCURRENCY_PER_HOST,
+    LINKCHECK_DELAY at least), throttled on their own.
+    With AUTOTHROTTLE_ENABLED, delays follow the observed latencies
+    (replaces scrapy's AutoThrottle).
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        settings = crawler.settings
+        self.enabled = settings.getbool('AUTOTHROTTLE_ENABLED')
+        self.debug = settings.getbool('AUTOTHROTTLE_DEBUG')
+        self.randomize = settings.getbool('RANDOMIZE_DOWNLOAD_DELAY')
+        self.engine_concurrency = settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')
+        self.engine_target = settings.getfloat('AUTOTHROTTLE_TARGET_CONCURRENCY')
+        self.engine_mindelay = settings.getfloat('DOWNLOAD_DELAY')
+        self.linkcheck_concurrency = settings.getint('LINKCHECK_CONCURRENCY_PER_HOST')
+        self.linkcheck_target = settings.getfloat('LINKCHECK_TARGET_CONCURRENCY')
+        self.linkcheck_mindelay = settings.getfloat('LINKCHECK_DELAY')
+        self.maxdelay = settings.getfloat('AUTOTHROTTLE_MAX_DELAY')
+        self.engine_delay = self.engine_mindelay
+        if self.enabled:
+            self.engine_delay = max(self.engine_mindelay, settings.getfloat('AUTOTHROTTLE_START_DELAY'))
+        self.ban_codes = set(settings.getlist('BAN_HTTP_CODES', [403, 429]))
+        self.engine_slot = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = cls(crawler)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(o.response_downloaded, signal=signals.response_downloaded)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def spider_opened(self, spider):
+        self.engine_slot = spider.__class__.__name__
+        if self.enabled and self.engine_slot in engine_delays:
+            self.engine_delay = min(max(engine_delays[self.engine_slot], self.engine_mindelay),
+                                    self.maxdelay)
+
+    def request_scheduled(self, request, spider):
+        slots = self.crawler.engine.downloader.slots
+        if request.meta.get('linkcheck'):
+            key = 'linkcheck:%s' % (urlparse_cached(request).hostname or '')
+            if key not in slots:
+                slots[key] = Slot(self.linkcheck_concurrency, self.linkcheck_mindelay, self.randomize)
+        else:
+            key = self.engine_slot
+            if key not in slots:
+                slots[key] = Slot(self.engine_concurrency, self.engine_delay, self.randomize)
+        request.meta['download_slot'] = key
+
+    def response_downloaded(self, response, request, spider):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return
+        olddelay = slot.delay
+        if key == self.engine_slot:
+            if response.status in self.ban_codes:
+                slot.delay = min(max(slot.delay * 2, self.engine_mindelay, 1), self.maxdelay)
+                self.crawler.stats.inc_value('throttle/backoff')
+                logger.warning('%s answered %d, slowing down to a %.1fs delay' % (
+                    key, response.status, slot.delay))
+            elif self.enabled:
+                self._adjust_delay(slot, request, response, self.engine_target, self.engine_mindelay)
+            self.engine_delay = slot.delay
+        elif self.enabled:
+            self._adjust_delay(slot, request, response, self.linkcheck_target, self.linkcheck_mindelay)
+        if self.debug:
+            logger.info('slot: %s | conc:%2d | delay:%5d ms (%+d) | latency:%5d ms' % (
+                key, len(slot.transferring), slot.delay * 1000, (slot.delay - olddelay) * 1000,
+                (request.meta.get('download_latency') or 0) * 1000))
+
+    def _adjust_delay(self, slot, request, response, target_concurrency, mindelay):
+        # (as scrapy's AutoThrottle)
+        latency = request.meta.get('download_latency')
+        if latency is None:
+            return
+        target_delay = latency / target_concurrency
+        new_delay = max(target_delay, (slot.delay + target_delay) / 2.0)
+        new_delay = min(max(mindelay, new_delay), self.maxdelay)
+        # (error pages are small and quick, they don't mean it's not busy)
+        if response.status != 200 and new_delay <= slot.delay:
+            return
+        slot.delay = new_delay
+
+    def spider_closed(self, spider):
+        if self.engine_slot:
+            engine_delays[self.engine_slot] = self.engine_delay
+
+def crawler_settings(settings):
+    """Scrapy settings for the search spiders, from the bot `settings`"""
 
     # telnet extension workaround
     # (simply including both in EXTENSIONS fails on scrapy 1.1+:
@@ -286,18 +950,21 @@ def crawler_setup(settings, *args, **kwargs):
     else:
         telnet_ext = 'scrapy.extensions.telnet.TelnetConsole'
 
-    # ResultCollectorPipeline file descriptor
-    # ...hacky, hacky, hacky :|
-    collector_pipeline_writer(kwargs.pop('writer'))
-
     default_settings = {
         'EXTENSIONS': {
             telnet_ext: None,
             'scrapy.extensions.spiderstate.SpiderState': None,
             'scrapy.extensions.corestats.CoreStats': None,
             'scrapy.extensions.logstats.LogStats': None,
+            'scrapy.extensions.throttle.AutoThrottle': None,
+            SearchThrottle: 0,
+            SearchProgress: 100,
+        },
+        'DOWNLOAD_HANDLERS': {
+            's3': None,
+            'http': '%s.LinkCheckDownloadHandler' % __name__,
+            'https': '%s.LinkCheckDownloadHandler' % __name__,
         },
-        'DOWNLOAD_HANDLERS': { 's3': None },
         'STATS_DUMP': False,
         'DOWNLOADER_STATS': False,
         'SPIDER_MODULES': [],
@@ -307,6 +974,7 @@ def crawler_setup(settings, *args, **kwargs):
             RetryMiddleware: 500,
             'scrapy.downloadermiddlewares.redirect.RedirectMiddleware': None,
             RewriteRedirectMiddleware: 600,
+            LinkCheckMiddleware: 50,
         },
         'ITEM_PIPELINES': {
             ResultCollectorPipeline: 800,
@@ -319,6 +987,10 @@ def crawler_setup(settings, *args, **kwargs):
     logging.getLogger('scrapy.middleware').setLevel(logging.WARNING)
     logging.getLogger('scrapy.core.engine').setLevel(logging.WARNING)
 
+    return settings
+
+def search_spiders(providers=None):
+    """Spider classes for all search `providers` (default: all of them)"""
     from .search import (
         KarmaDecay,
         Yandex,
@@ -326,16 +998,176 @@ def crawler_setup(settings, *args, **kwargs):
         Tineye,
         Google,
     )
-    spiders = [
-        (KarmaDecay, kwargs),
-        (Yandex, kwargs),
-        (Bing, kwargs),
-        (Tineye, kwargs),
-        (Google, kwargs),
-    ]
+    spiders = [KarmaDecay, Yandex, Bing, Tineye, Google]
+    if providers is not None:
+        spiders = [scls for scls in spiders if scls.__name__ in providers]
+    return spiders
+
+def crawler_setup(settings, *args, **kwargs):
+
+    # ResultCollectorPipeline file descriptor
+    # ...hacky, hacky, hacky :|
+    collector_pipeline_writer(kwargs.pop('writer'), settings.get('SEARCH_CHANNEL_SERIALIZER', 'marshal'))
+    start_search_job(kwargs.pop('started', None))
+
+    settings = crawler_settings(settings)
+    status = crawler_run(settings, **kwargs)
+    write_control('end', status=status or 0)
+    return status
 
+def crawler_run(settings, **kwargs):
     crawlerproc = CrawlerProcess(settings)
-    for spider in spiders:
-        (scls, sargs) = spider
-        crawlerproc.crawl(scls, **sargs)
+    for scls in search_spiders(kwargs.pop('providers', None)):
+        crawlerproc.crawl(scls, **kwargs)
     crawlerproc.start() # blocking call
+
+
+# persistent search worker
+from scrapy.crawler import CrawlerRunner
+
+def serve_search_jobs(settings, channel):
+    """Search worker main loop (see ..worker)
+
+    Runs search jobs read from `channel`, with all spiders sharing
+    one long-running reactor. Results are streamed back over `channel`
+    as they are scraped, tagged with their job; each job is terminated
+    with an 'end' control message. A job can be cancelled early,
+    its spiders are then stopped.
+    Jobs run one at a time (they share the search_job state), one
+    sent while another is still stopping waits for it to end.
+    HTTP connections are kept open across jobs (see shared_pool).
+    """
+    import threading
+    from collections import deque
+    from six.moves import cPickle as pickle
+
+    reader = channel.makefile('rb')
+    collector_pipeline_writer(channel.makefile('wb'), settings.get('SEARCH_CHANNEL_SERIALIZER', 'marshal'))
+
+    from twisted.internet.defer import DeferredList
+
+    settings = crawler_settings(settings)
+    settings.set('_SHARED_HTTP_POOL_', True) # (runtime setting)
+    runner = CrawlerRunner(settings)
+    crawlers = {} # job -> running crawlers
+    queued = deque() # jobs waiting for the running one to end
+
+    def job_done(_, job_id):
+        crawlers.pop(job_id, None)
+        write_control('end', job=job_id)
+        if queued:
+            run_job(*queued.popleft())
+
+    def run_job(job_id, spiderargs, started):
+        if crawlers:
+            logger.debug('Search job %s waits for job %s to stop' % (job_id, list(crawlers)[0]))
+            queued.append((job_id, spiderargs, started))
+            return
+        start_search_job(started)
+        logger.debug('Search job %s started' % job_id)
+        crawlers[job_id] = []
+        deferreds = []
+        providers = spiderargs.pop('providers', None)
+        for scls in search_spiders(providers):
+            crawler = runner.create_crawler(scls)
+            crawlers[job_id].append(crawler)
+            deferreds.append(runner.crawl(crawler, search_job=job_id, **spiderargs))
+        d = DeferredList(deferreds)
+        d.addBoth(lambda _: logger.debug('Search job %s finished in %.2fs' % (
+            job_id, time.time() - started)))
+        d.addBoth(job_done, job_id)
+
+    def cancel_job(job_id):
+        for job in queued:
+            if job[0] == job_id:
+                queued.remove(job)
+                write_control('end', job=job_id)
+                return
+        for crawler in crawlers.get(job_id, []):
+            if crawler.crawling:
+                crawler.stop()
+
+    def read_jobs():
+        # (blocking reads, off the reactor thread)
+        while True:
+            try:
+                message = pickle.load(reader)
+            except (EOFError, IOError, OSError, pickle.UnpicklingError):
+                break
+            if message[0] == 'search':
+                reactor.callFromThread(run_job, *message[1:])
+            elif message[0] == 'cancel':
+                reactor.callFromThread(cancel_job, *message[1:])
+        reactor.callFromThread(reactor.stop)
+
+    thread = threading.Thread(target=read_jobs, name='search-jobs')
+    thread.daemon = True
+    thread.start()
+    reactor.run(installSignalHandlers=False)
+
+
+# search forkserver
+def serve_forked_searches(settings, channel):
+    """Search forkserver main loop (see ..worker)
+
+    Forks a child for every search job read from `channel`. This
+    process has already done the imports and configuration, so the
+    children start crawling right away. Their results are relayed
+    back over `channel` frame by frame (so a killed child can not
+    leave half a message behind); the forkserver sends 'end' after each.
+    Cancelled jobs are killed by the search parent.
+    """
+    import os
+    from six.moves import cPickle as pickle
+
+    serializer = settings.get('SEARCH_CHANNEL_SERIALIZER', 'marshal')
+    reader = channel.makefile('rb')
+    writer = collector_pipeline_writer(channel.makefile('wb'), serializer)
+
+    settings = crawler_settings(settings)
+    search_spiders() # (import them now)
+
+    while True:
+        try:
+            message = pickle.load(reader)
+        except (EOFError, IOError, OSError, pickle.UnpicklingError):
+            break
+        if message[0] != 'search':
+            continue # (nothing left to cancel)
+        job_id, spiderargs, started = message[1:]
+
+        pipein, pipeout = os.pipe()
+        pid = fork()
+        if pid == 0: # child process
+            status = 0
+            try:
+                os.close(pipein)
+                collector_pipeline_writer(os.fdopen(pipeout, 'wb'), serializer)
+                # the wake-up pipe must not be shared with other children
+                waker = reactor.waker
+                reactor.removeReader(waker)
+                reactor._internalReaders.discard(waker)
+                waker.connectionLost(None)
+                reactor.waker = None
+                reactor.installWaker()
+
+                start_search_job(started)
+                crawler_run(settings, search_job=job_id, **spiderargs)
+                collector_pipeline_writer().close()
+            except BaseException:
+                logger.exception('Search job %s failed' % job_id)
+                status = 1
+            finally:
+                os._exit(status)
+
+        os.close(pipeout)
+        write_control('started', job=job_id, pid=pid)
+        relay = FrameReader(pipein)
+        while True:
+            frame = relay.read_frame()
+            if frame is None:
+                break
+            writer.write_frame(frame, flush=not relay.buffered())
+        os.close(pipein)
+        pid, status = os.waitpid(pid, 0)
+        write_control('end', job=job_id, status=status)
@@ -5,9 +5,11 @@ import json
 import base64
 import six
 import time
+import re
 import mimetypes
 from collections import OrderedDict
-from w3lib.html import get_meta_refresh
+from lxml import etree
+from w3lib.html import get_meta_refresh, replace_entities
 from urllib3.filepost import encode_multipart_formdata
 from six.moves.urllib.parse import (
     unquote, urlparse, urlsplit, urlunsplit, parse_qsl, urlencode,
@@ -31,6 +33,10 @@ except ImportError:
             return False
         def isredditspam_text(self, text):
             return False
+        def classify_results(self, results, fields=None):
+            return len(results)
+        def search_failed(self, kind, message):
+            self.logger.error(message)
 
 
 def convert_image(data):
@@ -53,11 +59,49 @@ def convert_image(data):
     return image, (width, height)
 
 
+# Result pages are parsed with XPath expressions compiled once (below),
+# evaluated on the lxml tree scrapy parsed a response into: first to
+# find the result container, then on each result in it.
+# (see benchmarks/bench_serp.py for their numbers)
+
+def XPath(path):
+    """Compiled XPath expression, call it with a node to evaluate it"""
+    return etree.XPath(path, smart_strings=False)
+
+def first(values):
+    """First of the values an XPath expression found (None if none)"""
+    return six.text_type(values[0]) if values else None
+
+def first_node(nodes):
+    return nodes[0] if nodes else None
+
+def attribute(element, name):
+    value = element.get(name)
+    return six.text_type(value) if value is not None else None
+
+def strings(values):
+    return [six.text_type(value) for value in values]
+
+def regex_groups(regex, values):
+    """All groups `regex` matches in `values` (as a Selector's re())"""
+    groups = []
+    for value in values:
+        for match in regex.findall(six.text_type(value)):
+            if isinstance(match, tuple):
+                groups.extend(match)
+            else:
+                groups.append(match)
+    return [replace_entities(group, keep=['lt', 'amp']) for group in groups]
+
+BODY = XPath('/html/body')
+
+
 class Search(InfoBotSpider):
 
     name = 'search'
 
     search_url = ''
+    captcha_urls = ('captcha', '/sorry/') # where search engines send suspected bots
 
     def __init__(self, *args, **kwargs):
         self.num_results = 10
@@ -73,8 +117,12 @@ class Search(InfoBotSpider):
         return response
 
     def parse(self, response):
-        content = response.xpath('//body') or ''
-        if content:
+        if any(marker in response.url.lower() for marker in self.captcha_urls):
+            self.search_failed('banned', 'Captcha page instead of search results: %s' % response.url)
+            return
+        # (an lxml element, not a Selector)
+        content = first_node(BODY(response.selector.root))
+        if content is not None:
             self.serp = response.url
         self.logger.info('Visited %s', response.url)
 
@@ -120,8 +168,8 @@ class ImageSearch(Search):
         # Retry initial search requests on _any_ error event.
         # Any observed errors were transient errors (even a 404),
         # but would lose us a whole batch of results at once.
-        # (Excepting the possibility of a ban)
-        request.meta['retry_http_codes'] = self.ERROR_HTTP_CODES
+        # (Excepting the possibility of a ban, that is not retried)
+        request.meta['retry_http_codes'] = self.ERROR_HTTP_CODES - self.BAN_HTTP_CODES
         yield self.pre_search(request)
 
     @staticmethod
@@ -214,32 +262,48 @@ class KarmaDecay(ImageSearch):
         }
         return Request(self.search_image_url, method='POST', body=body, headers=headers)
 
+    xpath_no_results = XPath('//tr[contains(@class, "ns")]')
+    xpath_rows = XPath('.//div[@id="content"]/table[@class="search"]//tr[@class="result" or @class="ls"]')
+    xpath_image = XPath('td[@class="img"]/a/@href')
+    xpath_image_size = XPath('td[@class="info"]/div[@class="similar"]/span[contains(.//text(), " x ")]//text()')
+    xpath_link = XPath('td[@class="info"]/div[@class="title"]/a/@href')
+    xpath_title = XPath('td[@class="info"]/div[@class="title"]/a/text()')
+    xpath_text = XPath('td[@class="info"]/div[@class="submitted"]//text()[normalize-space()]')
+
     def parse_search(self, response, content):
-        no_results = content.xpath('//tr[contains(@class, "ns")]') # "No very similar images were found on Reddit."
+        no_results = self.xpath_no_results(content) # "No very similar images were found on Reddit."
         if no_results:
             self.logger.info('No search results')
             return
 
         # ignore 'less similar' results. they're usually completely different
-        results = content.xpath('.//div[@id="content"]/table[@class="search"]//tr[@class="result"][following-sibling::tr[@class="ls"]]')
+        # (those after the "ls" row, found in one pass over the rows)
+        results = []
+        similar = None
+        for row in self.xpath_rows(content):
+            if row.get('class') == 'ls':
+                similar = len(results)
+            else:
+                results.append(row)
+        if similar:
+            results = results[:similar]
         if not results:
-            results = content.xpath('.//div[@id="content"]/table[@class="search"]//tr[@class="result"]')
-            if not results:
-                self.logger.info('No search results')
+            self.logger.info('No search results')
 
         rc = response.meta.get('rc') or 0 # result counter
         num_results = response.meta.get('num_results') or 0
+        page = []
         for found in results:
-            source_image = found.xpath('td[@class="img"]/a/@href').extract_first()
-            source_image_size = found.xpath('td[@class="info"]/div[@class="similar"]/span[contains(.//text(), " x ")]//text()').extract_first()
+            source_image = first(self.xpath_image(found))
+            source_image_size = first(self.xpath_image_size(found))
             source_image_size = [s.strip() for s in source_image_size.split('x')] # w x h
             source_image_size = 'x'.join(source_image_size)
 
-            source_link = found.xpath('td[@class="info"]/div[@class="title"]/a/@href').extract_first()
-            source_title = found.xpath('td[@class="info"]/div[@class="title"]/a/text()').extract_first()
-            source_text = found.xpath('td[@class="info"]/div[@class="submitted"]//text()[normalize-space()]')
+            source_link = first(self.xpath_link(found))
+            source_title = first(self.xpath_title(found))
+            source_text = self.xpath_text(found)
             stext = []
-            for s in source_text.extract():
+            for s in strings(source_text):
                 s = s.split()
                 s = [x.strip() for x in s]
                 s = ' '.join(s)
@@ -262,19 +326,11 @@ class KarmaDecay(ImageSearch):
                 'image_format': source_image_format,
             }
             rc += 1
+            page.append(result)
 
-            # mark probable spam (and don't count towards result limit)
-            if self.isredditspam_link(result['url']):
-                result['spam'] = 'url'
-            elif self.isredditspam_text(result['title']):
-                result['spam'] = 'title'
-            elif self.isredditspam_text(result['description']):
-                result['spam'] = 'description'
-            elif self.isredditspam_link(result['image_url']):
-                result['spam'] = 'image_url'
-            else:
-                num_results += 1
-
+        # mark probable spam (and don't count towards result limit)
+        num_results += self.classify_results(page)
+        for result in page:
             result = SearchResultItem(result)
             yield self.parse_result(result)
 
@@ -348,8 +404,16 @@ class Yandex(ImageSearch):
         result = SearchResultItem(result)
         yield self.parse_result(result)
 
+    xpath_results = XPath('.//ul[@class="other-sites__container"]/li')
+    xpath_image = XPath('a[@class="other-sites__preview-link"]/@href')
+    xpath_image_size = XPath('.//div[contains(@class, "other-sites__meta")]/text()')
+    xpath_link = XPath('.//a[contains(@class, "other-sites__title-link")]/@href')
+    xpath_displaylink = XPath('.//a[contains(@class, "other-sites__outer-link")]/text()')
+    xpath_title = XPath('.//a[contains(@class, "other-sites__title-link")]/text()')
+    xpath_text = XPath('.//a[contains(@class, "other-sites__desc")]/text()')
+
     def parse_search(self, response, content):
-        results = content.xpath('.//ul[@class="other-sites__container"]/li')
+        results = self.xpath_results(content)
         if not results:
             self.logger.info('No search results')
             #similar = content.xpath('.//ul[@class="similar__thumbs"]/li/a') # /@href + /img/@src
@@ -357,16 +421,17 @@ class Yandex(ImageSearch):
 
         rc = response.meta.get('rc') or 0 # result counter
         num_results = response.meta.get('num_results') or 0
+        page = []
         for found in results:
-            source_image = found.xpath('a[@class="other-sites__preview-link"]/@href').extract_first()
-            source_image_size = found.xpath('.//div[contains(@class, "other-sites__meta")]/text()').extract_first()
+            source_image = first(self.xpath_image(found))
+            source_image_size = first(self.xpath_image_size(found))
             source_image_size = [s.strip() for s in source_image_size.split(u'×')] # w x h
             source_image_size = 'x'.join(source_image_size)
 
-            source_link = found.xpath('.//a[contains(@class, "other-sites__title-link")]/@href').extract_first()
-            source_displaylink = found.xpath('.//a[contains(@class, "other-sites__outer-link")]/text()').extract_first()
-            source_title = found.xpath('.//a[contains(@class, "other-sites__title-link")]/text()').extract_first()
-            source_text = found.xpath('.//a[contains(@class, "other-sites__desc")]/text()').extract_first() # not in image upload
+            source_link = first(self.xpath_link(found))
+            source_displaylink = first(self.xpath_displaylink(found))
+            source_title = first(self.xpath_title(found))
+            source_text = first(self.xpath_text(found)) # not in image upload
 
             source_image_format = self.guess_filetype(source_image)
 
@@ -384,18 +449,12 @@ class Yandex(ImageSearch):
                 'image_format': source_image_format,
             }
             rc += 1
+            page.append(result)
 
-            # mark probable spam (and don't count towards result limit)
-            if self.isredditspam_text(result['title']):
-                result['spam'] = 'title'
-            elif self.isredditspam_text(result['description']):
-                result['spam'] = 'description'
-            elif self.isredditspam_link(result['image_url']):
-                result['spam'] = 'image_url'
-            else:
-                num_results += 1
-
-            yield Request(source_link, callback=self.get_url, meta={'dont_redirect': True, 'result': result})
+        # mark probable spam (and don't count towards result limit)
+        num_results += self.classify_results(page, fields=('title', 'description', 'image_url'))
+        for result in page:
+            yield Request(result['url'], callback=self.get_url, meta={'dont_redirect': True, 'result': result})
 
         if num_results > self.num_results:
             return
@@ -501,21 +560,30 @@ class Bing(ImageSearch):
         return Request(self.search_image_url + qstring, method='POST', cookies=self.cookies,
                        body=body, headers=headers, callback=self.parse_image)
 
+    xpath_results = XPath('.//div[@id="sbi_sct_sp"]/div[@class="sbi_sp"]')
+    xpath_image = XPath('div[@class="th"]/a/@href')
+    xpath_image_metainfo = XPath('div[@class="info"]/div[@class="si"][contains(text(), " x ")]/text()')
+    xpath_link = XPath('div[@class="info"]/a/@href')
+    xpath_title = XPath('div[@class="info"]/a/text()')
+    xpath_displaylink = XPath('div[@class="info"]/div[@class="st"]/text()')
+    re_image_metainfo = re.compile(ur'^(.*)·(.*)·(.*)$', re.UNICODE)
+
     def parse_search(self, response, content):
-        results = content.xpath('.//div[@id="sbi_sct_sp"]/div[@class="sbi_sp"]')
+        results = self.xpath_results(content)
         if not results:
             self.logger.info('No search results')
             if "Sorry, we can't search by image with" in response.body:
                 self.logger.info('Search was not an image link?')
             elif "We couldn't find any matches for this image." not in response.body:
-                self.logger.warning('Unknown search fail.')
+                self.search_failed('anomaly', 'Unknown search fail.')
             return
 
         rc = response.meta.get('rc') or 0 # result counter
         num_results = response.meta.get('num_results') or 0
+        page = []
         for found in results:
-            source_image = found.xpath('div[@class="th"]/a/@href').extract_first()
-            source_image_metainfo = found.xpath('div[@class="info"]/div[@class="si"][contains(text(), " x ")]/text()').re(ur'^(.*)·(.*)·(.*)$')
+            source_image = first(self.xpath_image(found))
+            source_image_metainfo = regex_groups(self.re_image_metainfo, self.xpath_image_metainfo(found))
             source_image_size = source_image_metainfo[0]
             source_image_filesize = source_image_metainfo[1]
             source_image_filesize = '%s KiB' % source_image_filesize
@@ -529,9 +597,9 @@ class Bing(ImageSearch):
             source_image_size = [s.strip() for s in source_image_size.split('x')] # w x h
             source_image_size = 'x'.join(source_image_size)
 
-            source_link = found.xpath('div[@class="info"]/a/@href').extract_first()
-            source_title = found.xpath('div[@class="info"]/a/text()').extract_first()
-            source_displaylink = found.xpath('div[@class="info"]/div[@class="st"]/text()').extract_first()
+            source_link = first(self.xpath_link(found))
+            source_title = first(self.xpath_title(found))
+            source_displaylink = first(self.xpath_displaylink(found))
 
             result = {
                 'id': rc,
@@ -547,26 +615,28 @@ class Bing(ImageSearch):
                 'image_format': source_image_format,
             }
             rc += 1
+            page.append(result)
 
-            # mark probable spam (and don't count towards result limit)
-            if self.isredditspam_link(result['url']):
-                result['spam'] = 'url'
-            elif self.isredditspam_text(result['title']):
-                result['spam'] = 'title'
-            elif self.isredditspam_text(result['description']):
-                result['spam'] = 'description'
-            elif self.isredditspam_link(result['image_url']):
-                result['spam'] = 'image_url'
-            else:
-                num_results += 1
-
+        # mark probable spam (and don't count towards result limit)
+        num_results += self.classify_results(page)
+        for result in page:
             result = SearchResultItem(result)
             yield self.parse_result(result)
 
         # There doesn't seem to be any pagination in results here ever! :heart:
 
+    xpath_upload_results = XPath('.//div[@id="insights"]')
+    xpath_estimated_results = XPath('.//ul[@class="insights"]//div[contains(@class, "b_focusLabel")]/text()')
+    xpath_insights_results = XPath('.//ul[@class="insights"]//ul[@class="expbody"]/li')
+    xpath_insights_link = XPath('a/@href')
+    xpath_insights_displaylink = XPath('a/div[@class="iscbody"]//ul[@class="b_dataList"]/li[1]/text()')
+    xpath_insights_title = XPath('a/div//span[@title]/text()')
+    xpath_insights_metainfo = XPath('a/div[@class="iscbody"]//ul[@class="b_dataList"]/li[2]/text()')
+    re_estimated_results = re.compile(r'^(\d+)', re.UNICODE)
+    re_insights_metainfo = re.compile(ur'^(\d+) x (\d+) · (\d+) kB · (.*)$', re.UNICODE)
+
     def parse_image(self, response):
-        content = response.xpath('//body')
+        content = first_node(BODY(response.selector.root))
         self.logger.info('Visited %s', response.url)
 
         def gimmefrigginresults():
@@ -641,7 +711,7 @@ class Bing(ImageSearch):
                            meta={'serp': response.url, 'more': more})
 
 
-        upload_results = content.xpath('.//div[@id="insights"]')
+        upload_results = self.xpath_upload_results(content) if content is not None else []
         if upload_results:
             # need more results? follow "hidden" alternative image listing if available
             more = response.xpath('.//div[@id="detail_meta"]//span[@class="line_wrapper"]/a[@id="att_fi"]/@href').extract_first()
@@ -668,22 +738,26 @@ class Bing(ImageSearch):
         serp = response.meta.get('serp') or response.url
 
         # number of results found (if any)
-        estimated_result_number = content.xpath('.//ul[@class="insights"]//div[contains(@class, "b_focusLabel")]/text()').re_first(r'^(\d+)')
+        estimated_result_number = None
+        results = []
+        if content is not None:
+            estimated_result_number = first(regex_groups(self.re_estimated_results, self.xpath_estimated_results(content)))
+            results = self.xpath_insights_results(content)
         if estimated_result_number:
             estimated_result_number = int(estimated_result_number)
             self.logger.info('Estimated Result number %d' % estimated_result_number)
 
-        results = content.xpath('.//ul[@class="insights"]//ul[@class="expbody"]/li')
         #results = content.xpath('.//ul[@class="insights"]//ul[@class="expbody"]/li[a]')
 
         rc = response.meta.get('rc') or 0 # result counter
         num_results = response.meta.get('num_results') or 0
+        page = []
         for found in results:
-            source_link = found.xpath('a/@href').extract_first()
-            source_displaylink = found.xpath('a/div[@class="iscbody"]//ul[@class="b_dataList"]/li[1]/text()').extract_first() # preview link [no protocol]
+            source_link = first(self.xpath_insights_link(found))
+            source_displaylink = first(self.xpath_insights_displaylink(found)) # preview link [no protocol]
 
-            source_title = found.xpath('a/div//span[@title]/text()').extract_first()
-            source_image_metainfo = found.xpath('a/div[@class="iscbody"]//ul[@class="b_dataList"]/li[2]/text()').re(ur'^(\d+) x (\d+) · (\d+) kB · (.*)$')
+            source_title = first(self.xpath_insights_title(found))
+            source_image_metainfo = regex_groups(self.re_insights_metainfo, self.xpath_insights_metainfo(found))
             try:
                 width, height, source_image_filesize, source_image_format = source_image_metainfo
             except ValueError:
@@ -712,19 +786,11 @@ class Bing(ImageSearch):
                 'image_format': source_image_format,
             }
             rc += 1
+            page.append(result)
 
-            # mark probable spam (and don't count towards result limit)
-            if self.isredditspam_link(result['url']):
-                result['spam'] = 'url'
-            elif self.isredditspam_text(result['title']):
-                result['spam'] = 'title'
-            elif self.isredditspam_text(result['description']):
-                result['spam'] = 'description'
-            #elif self.isredditspam_link(result['image_url']):
-            #    result['spam'] = 'image_url'
-            else:
-                num_results += 1
-
+        # mark probable spam (and don't count towards result limit)
+        num_results += self.classify_results(page, fields=('url', 'title', 'description'))
+        for result in page:
             result = SearchResultItem(result)
             yield self.parse_result(result)
 
@@ -738,16 +804,19 @@ class Bing(ImageSearch):
         if more_link:
             yield Request(more_link, meta={'num_results': num_results, 'rc': rc}, callback=self.parse_more)
 
+    xpath_more_results = XPath('.//div[@id="dg_c"]//div[@class="dg_b"]/div[@class="imgres"]/div[@class="dg_u"]//a')
+    xpath_more_thumb = XPath('img/@src')
+
     def parse_more(self, response):
-        content = response.xpath('//body')
+        content = first_node(BODY(response.selector.root))
         self.logger.info('Visited %s', response.url)
 
-        results = content.xpath('.//div[@id="dg_c"]//div[@class="dg_b"]/div[@class="imgres"]/div[@class="dg_u"]//a')
+        results = self.xpath_more_results(content) if content is not None else []
 
         rc = response.meta.get('rc') or 0 # result counter
         num_results = response.meta.get('num_results') or 0
         for found in results:
-            source_image_metainfo = found.xpath('@t2').re(ur'^(\d+) x (\d+) · (\d+) kB · (.*)$')
+            source_image_metainfo = regex_groups(self.re_insights_metainfo, [attribute(found, 't2') or ''])
             try:
                 width, height, source_image_filesize, source_image_format = source_image_metainfo
             except ValueError:
@@ -758,22 +827,21 @@ class Bing(ImageSearch):
             #_size = _size * 1024 # base value Bytes
             #source_image_filesize = str(_size / 1024) + ' KiB' # list in KiB
 
-            json_metadata = found.xpath('@m').extract_first()
+            json_metadata = attribute(found, 'm')
             result = {
                 'id': rc,
                 'provider': self.__class__.__name__,
-                'url': response.urljoin(found.xpath('@t3').extract_first()),
-                'title': found.xpath('@t1').extract_first(),
+                'url': response.urljoin(attribute(found, 't3')),
+                'title': attribute(found, 't1'),
                 'description': None, # has no text description
                 'serp': response.url,
-                'image_url': response.urljoin(found.xpath('@href').extract_first()),
-                #'image_url': response.urljoin(found.xpath('@ihk').extract_first()),
+                'image_url': response.urljoin(attribute(found, 'href')),
+                #'image_url': response.urljoin(attribute(found, 'ihk')),
                 'image_size': source_image_size,
                 'image_filesize': source_image_filesize,
                 'image_format': source_image_format,
-                'image_thumb_url': found.xpath('img/@src').extract_first(),
-                'image_thumb_size': '%dx%d' % (int(found.xpath('@hh').extract_first()),
-                                         int(found.xpath('@hw').extract_first())),
+                'image_thumb_url': first(self.xpath_more_thumb(found)),
+                'image_thumb_size': '%dx%d' % (int(found.get('hh')), int(found.get('hw'))),
             }
             rc += 1
 
@@ -814,36 +882,49 @@ class Tineye(ImageSearch):
         }
         return Request(self.search_image_url, method='POST', body=body, headers=headers)
 
+    xpath_results = XPath('.//div[@class="results"]//div[@class="row matches"]//div[contains(@class, "match-row")]')
+    xpath_estimated_results = XPath('.//div[@class="query-summary"]//div[contains(@class, "search-details")]/h2/text()')
+    xpath_image = XPath('.//div[@class="match"]/p[contains(@class, "short-image-link")]/a/@href')
+    xpath_image_size = XPath('.//div[contains(@class, "match-thumb")]/p/span[2]/text()')
+    xpath_image_format = XPath('.//div[contains(@class, "match-thumb")]/p/span[1]/text()')
+    xpath_image_filesize = XPath('.//div[contains(@class, "match-thumb")]/p/span[3]/text()')
+    xpath_link = XPath('.//div[@class="match"]/p[not(@class)]/a/@href')
+    xpath_title = XPath('.//div[@class="match"]/h4[@title]/text()')
+    xpath_text = XPath('.//div[@class="match"]/p[@class="crawl-date"]/text()')
+    xpath_more_link = XPath('.//div[@class="pagination"]/span[@class="current"]/following-sibling::a/@href')
+    re_estimated_results = re.compile(r'^(\d+) Results', re.UNICODE)
+
     def parse_search(self, response, content):
-        results = content.xpath('.//div[@class="results"]//div[@class="row matches"]//div[contains(@class, "match-row")]')
+        results = self.xpath_results(content)
         if not results:
             self.logger.info('No search results')
         if 'Your IP has been blocked' in response.body:
-            self.logger.error('Tineye IP ban')
-        if '403 Forbidden' in response.body: # hmm, error shouldn't even reach us
-            self.logger.error('Tineye blocked us')
+            self.search_failed('banned', 'Tineye IP ban')
+        elif '403 Forbidden' in response.body: # hmm, error shouldn't even reach us
+            self.search_failed('banned', 'Tineye blocked us')
 
-        estimated_result_number = content.xpath('.//div[@class="query-summary"]//div[contains(@class, "search-details")]/h2/text()').re_first(r'^(\d+) Results')
+        estimated_result_number = first(regex_groups(self.re_estimated_results, self.xpath_estimated_results(content)))
         if estimated_result_number:
             estimated_result_number = int(estimated_result_number)
             self.logger.info('Estimated Result number %d' % estimated_result_number)
 
         rc = response.meta.get('rc') or 0 # result counter
         num_results = response.meta.get('num_results') or 0
+        page = []
         for found in results:
             # NOTE: this ignores possible multiple matches per (sub)domains (of the same file), as listed by tineye
-            source_image = found.xpath('.//div[@class="match"]/p[contains(@class, "short-image-link")]/a/@href').extract_first()
-            source_image_size = found.xpath('.//div[contains(@class, "match-thumb")]/p/span[2]/text()').extract_first()
+            source_image = first(self.xpath_image(found))
+            source_image_size = first(self.xpath_image_size(found))
             source_image_size = source_image_size.strip(',')
             source_image_size = [s.strip() for s in source_image_size.split('x')] # w x h
             source_image_size = 'x'.join(source_image_size)
 
-            source_image_format = found.xpath('.//div[contains(@class, "match-thumb")]/p/span[1]/text()').extract_first()
+            source_image_format = first(self.xpath_image_format(found))
             source_image_format = source_image_format.strip(',')
             _source_image_format = self.guess_filetype('file.%s' % source_image_format)
             if _source_image_format:
                 source_image_format = _source_image_format
-            source_image_filesize = found.xpath('.//div[contains(@class, "match-thumb")]/p/span[3]/text()').extract_first()
+            source_image_filesize = first(self.xpath_image_filesize(found))
             source_image_filesize = source_image_filesize.strip(',')
             try:
                 _size, _unit = source_image_filesize.split()
@@ -856,9 +937,9 @@ class Tineye(ImageSearch):
                 source_image_filesize = str(_size / 1024) + ' KiB' # list in KiB
             except ValueError: pass
 
-            source_link = found.xpath('.//div[@class="match"]/p[not(@class)]/a/@href').extract_first()
-            source_title = found.xpath('.//div[@class="match"]/h4[@title]/text()').extract_first()
-            source_text = found.xpath('.//div[@class="match"]/p[@class="crawl-date"]/text()').extract_first()
+            source_link = first(self.xpath_link(found))
+            source_title = first(self.xpath_title(found))
+            source_text = first(self.xpath_text(found))
 
             result = {
                 'id': rc,
@@ -874,26 +955,18 @@ class Tineye(ImageSearch):
                 'image_format': source_image_format,
             }
             rc += 1
+            page.append(result)
 
-            # mark probable spam (and don't count towards result limit)
-            if self.isredditspam_link(result['url']):
-                result['spam'] = 'url'
-            elif self.isredditspam_text(result['title']):
-                result['spam'] = 'title'
-            elif self.isredditspam_text(result['description']):
-                result['spam'] = 'description'
-            elif self.isredditspam_link(result['image_url']):
-                result['spam'] = 'image_url'
-            else:
-                num_results += 1
-
+        # mark probable spam (and don't count towards result limit)
+        num_results += self.classify_results(page)
+        for result in page:
             result = SearchResultItem(result)
             yield self.parse_result(result)
 
         if num_results > self.num_results:
             return
 
-        more_link = content.xpath('.//div[@class="pagination"]/span[@class="current"]/following-sibling::a/@href').extract_first()
+        more_link = first(self.xpath_more_link(content))
         if more_link:
             yield Request(response.urljoin(more_link), meta={'num_results': num_results, 'rc': rc}, callback=self.parse)
 
@@ -938,36 +1011,49 @@ class Google(ImageSearch):
         }
         return Request(self.search_image_url, method='POST', body=body, headers=headers)
 
+    xpath_estimated_results = XPath('.//div[@id="resultStats"]/text()')
+    xpath_results = XPath('.//div[contains(@class, "normal-header")][div[contains(text(), "Pages that include matching images")]]/following-sibling::*//*[@class="rc"]')
+    xpath_all_results = XPath('.//*[@class="rc"]')
+    xpath_link = XPath('.//*[@class="r"]//a/@href')
+    xpath_title = XPath('.//*[@class="r"]//a/text()')
+    xpath_displaylink = XPath('.//*[@class="s"]//cite/text()')
+    xpath_text = XPath('.//*[@class="s"]//*[@class="st"]//text()[not(parent::span[@class="f"])]')
+    xpath_image_metadata = XPath('.//*[@class="s"]//*[@class="st"]/span[@class="f"]/text()')
+    xpath_image_meta = XPath('.//*[@class="s"]//div/a[g-img/img]/@href')
+    xpath_more_link = XPath('.//*[@id="nav"][@role="presentation"]//td[@class="cur"]/following-sibling::td/a/@href')
+    re_estimated_results = re.compile(r'bout (\d+) results', re.UNICODE)
+
     def parse_search(self, response, content):
         if 'Images must be smaller than' in response.body:
             # 20MB limit. Result is empty
             # FIXME: retry with a first-frame picture?
             return
 
-        estimated_result_number = content.xpath('.//div[@id="resultStats"]/text()').re_first(r'bout (\d+) results')
+        estimated_result_number = first(regex_groups(self.re_estimated_results, self.xpath_estimated_results(content)))
         if estimated_result_number:
             estimated_result_number = int(estimated_result_number)
             self.logger.info('Estimated Result number %d' % estimated_result_number)
 
         # exclude ads, thanks
-        results = content.xpath('.//div[contains(@class, "normal-header")][div[contains(text(), "Pages that include matching images")]]/following-sibling::*//*[@class="rc"]')
+        results = self.xpath_results(content)
         if not results:
-            results = content.xpath('.//*[@class="rc"]')
+            results = self.xpath_all_results(content)
             if not results:
                 self.logger.info('No search results')
 
         rc = response.meta.get('rc') or 0 # result counter
         num_results = response.meta.get('num_results') or 0
+        page = []
         for found in results:
-            source_link = found.xpath('.//*[@class="r"]//a/@href').extract_first()
-            source_title = found.xpath('.//*[@class="r"]//a/text()').extract()
+            source_link = first(self.xpath_link(found))
+            source_title = strings(self.xpath_title(found))
             source_title = ''.join(source_title)
 
-            source_displaylink = found.xpath('.//*[@class="s"]//cite/text()').extract_first()
-            source_text = found.xpath('.//*[@class="s"]//*[@class="st"]//text()[not(parent::span[@class="f"])]').extract()
+            source_displaylink = first(self.xpath_displaylink(found))
+            source_text = strings(self.xpath_text(found))
             source_text = ''.join(source_text)
 
-            _image_metadata = found.xpath('.//*[@class="s"]//*[@class="st"]/span[@class="f"]/text()').extract_first() or ''
+            _image_metadata = first(self.xpath_image_metadata(found)) or ''
             _image_metadata = [s.strip() for s in _image_metadata.split('-')] # image - date -
             _image_metadata.reverse()
             source_image_size = publish_date = None
@@ -981,9 +1067,8 @@ class Google(ImageSearch):
             #    publish_date = time.mktime(time.strptime(publish_date, '%b %d, %Y')) # 'Dec 27, 2013'
             #except (IndexError, ValueError): pass
 
-            preview_image = found.xpath('.//*[@class="s"]//div/a/g-img/img/@src')
             source_image = None
-            _source_image_meta = found.xpath('.//*[@class="s"]//div/a[g-img/img]/@href').extract_first()
+            _source_image_meta = first(self.xpath_image_meta(found))
             if _source_image_meta:
                 _source_image_meta = dict(parse_qsl(urlsplit(_source_image_meta).query))
                 source_image = _source_image_meta['imgurl']
@@ -1013,25 +1098,17 @@ class Google(ImageSearch):
                 'image_format': source_image_format,
             }
             rc += 1
+            page.append(result)
 
-            # mark probable spam (and don't count towards result limit)
-            if self.isredditspam_link(result['url']):
-                result['spam'] = 'url'
-            elif self.isredditspam_text(result['title']):
-                result['spam'] = 'title'
-            elif self.isredditspam_text(result['description']):
-                result['spam'] = 'description'
-            elif self.isredditspam_link(result['image_url']):
-                result['spam'] = 'image_url'
-            else:
-                num_results += 1
-
+        # mark probable spam (and don't count towards result limit)
+        num_results += self.classify_results(page)
+        for result in page:
             result = SearchResultItem(result)
             yield self.parse_result(result)
 
         if num_results > self.num_results:
             return
 
-        more_link = content.xpath('.//*[@id="nav"][@role="presentation"]//td[@class="cur"]/following-sibling::td/a/@href').extract_first()
+        more_link = first(self.xpath_more_link(content))
         if more_link:
             yield Request(response.urljoin(more_link), meta={'num_results': num_results, 'rc': rc}, callback=self.parse)
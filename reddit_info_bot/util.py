@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 import sys, os
+import re
+import time
 import logging
+import threading
 import codecs
+import tempfile
 import unicodedata
 import six
 import imp
+import marshal
+import hashlib
 import daemon  # python-daemon on pypi + debian
 try:
     from cStringIO import StringIO as BytesIO
@@ -26,32 +32,153 @@ logger = logging.getLogger(__name__)
 
 psl_cached = None
 
-def cached_psl(fh):
+PSL_SNAPSHOT_VERSION = 1
+
+def _psl_filenames(cachedir):
+    return ('{0}public_suffix_list.dat'.format(cachedir),
+            '{0}public_suffix_list.cache'.format(cachedir))
+
+def _psl_signature(filename):
+    # (marshal data is only readable by the same python version)
+    stat = os.stat(filename)
+    return [PSL_SNAPSHOT_VERSION, '%d.%d' % sys.version_info[:2],
+            stat.st_size, int(stat.st_mtime)]
+
+def psl_signature(cachedir=''):
+    """Identify the contents of the cached PublicSuffixList (empty if there is none)"""
+    datfile, snapshotfile = _psl_filenames(cachedir)
+    if not os.path.isfile(datfile):
+        return []
+    return [file_digest(datfile)]
+
+def _load_psl_snapshot(filename, signature, memo_size):
+    """The precompiled PublicSuffixList, if it was built from `signature`
+
+    Snapshot layout: signature, rule tree (both marshalled).
+    """
+    try:
+        with open(filename, 'rb') as inf:
+            if marshal.load(inf) != signature:
+                return None
+            root = marshal.load(inf)
+    except (IOError, OSError, EOFError, TypeError, ValueError):
+        return None
+    return PublicSuffixList.from_rules(root, memo_size=memo_size)
+
+def _save_psl(datfile, snapshotfile, psl, data=None):
+    try:
+        if data is not None:
+            write_file_atomic(datfile, data)
+        write_file_atomic(snapshotfile, marshal.dumps(_psl_signature(datfile)) +
+                          marshal.dumps(psl.root))
+    except (IOError, OSError) as e:
+        logger.warning('Could not write PublicSuffixList cache: %s' % e)
+
+def _fetch_psl():
+    try:
+        with download_psl() as inf:
+            data = inf.read().encode('utf-8')
+    except Exception as e:
+        logger.warning('PublicSuffixList download failed: %s' % e)
+        return None
+    if not data.strip():
+        logger.warning('PublicSuffixList download failed: empty response')
+        return None
+    return data
+
+def cached_psl(cachedir='', memo_size=10000):
+    """Load the PublicSuffixList
+
+    From the precompiled snapshot in `cachedir` if it is up to date,
+    else from the cached list file (downloading it if there is none).
+    """
     global psl_cached
     if not psl_cached:
-        fh.seek(0, os.SEEK_END)
-        size = fh.tell()
-        fh.seek(0)
-        if size <= 0:
+        datfile, snapshotfile = _psl_filenames(cachedir)
+        if not os.path.isfile(datfile) or os.path.getsize(datfile) <= 0:
             logger.debug('No cached PublicSuffixList data, downloading')
-            with download_psl() as inf:
-                psl_cached = inf.read().encode('utf-8')
-                fh.write(psl_cached)
+            data = _fetch_psl()
+            if data is None:
+                return None # (falls back to second-level domains)
+            psl = PublicSuffixList(data.splitlines(), memo_size=memo_size)
+            _save_psl(datfile, snapshotfile, psl, data)
+            psl.version = hashlib.sha1(data).hexdigest()
         else:
-            psl_cached = PublicSuffixList(fh)
+            psl = _load_psl_snapshot(snapshotfile, _psl_signature(datfile), memo_size)
+            if psl is None:
+                with open(datfile, 'rb') as inf:
+                    psl = PublicSuffixList(inf, memo_size=memo_size)
+                _save_psl(datfile, snapshotfile, psl)
+            psl.version = file_digest(datfile)
+        psl_cached = psl
         logger.debug('PublicSuffixList loaded')
     return psl_cached
 
+def refresh_psl(cachedir='', max_age=604800):
+    """Re-download the PublicSuffixList if older than `max_age` seconds
+
+    The new list replaces `psl_cached` in one assignment (processes
+    forked earlier keep theirs). Returns True if it was replaced.
+    (Its `version`, a hash of the list, tells results which
+     depend on it apart, see spamfilter._verdict_tag.)
+    """
+    global psl_cached
+    datfile, snapshotfile = _psl_filenames(cachedir)
+    if os.path.isfile(datfile) and \
+            time.time() - os.path.getmtime(datfile) <= max_age:
+        return False
+    logger.info('Updating PublicSuffixList')
+    data = _fetch_psl()
+    if data is None:
+        return False
+    memo_size = psl_cached.memo_size if psl_cached else 10000
+    psl = PublicSuffixList(data.splitlines(), memo_size=memo_size)
+    psl.version = hashlib.sha1(data).hexdigest()
+    with fork_lock:
+        # (swapped before the files change, which may trigger a spamfilter rebuild)
+        psl_cached = psl
+        _save_psl(datfile, snapshotfile, psl, data)
+    return True
+
+_psl_refresh_thread = None
+
+def start_psl_refresh(cachedir='', max_age=604800, interval=3600):
+    """Keep the PublicSuffixList up to date from a background thread"""
+    global _psl_refresh_thread
+    if not max_age or _psl_refresh_thread is not None:
+        return
+
+    def refresh():
+        while True:
+            time.sleep(min(interval, max_age))
+            try:
+                refresh_psl(cachedir, max_age)
+            except Exception as e:
+                logger.warning('PublicSuffixList update failed: %s' % e)
+
+    _psl_refresh_thread = threading.Thread(target=refresh, name='psl-refresh')
+    _psl_refresh_thread.daemon = True
+    _psl_refresh_thread.start()
+
 def tld_from_suffix(suffix):
     return '.'.join(suffix.split('.')[1:])
 
+_netloc_re = re.compile(r'^(?:https?:)?//([^/?#]*)', re.I)
+
+def url_netloc(url):
+    """urlsplit(url).netloc, without a full parse for common HTTP URLs"""
+    match = _netloc_re.match(url)
+    if match:
+        return match.group(1)
+    return urlsplit(url).netloc
+
 def domain_suffix(url):
     """ Return the authoritative part of a domain
 
     (usually the second-level domain), by using public-suffix list data.
     For convenience, also return the full domain that was recognized.
     """
-    domain = urlsplit(url).netloc
+    domain = url_netloc(url)
     if psl_cached:
         # return public suffix
         ps = psl_cached.get_public_suffix(domain)
@@ -91,6 +218,33 @@ def string_translate(text, intab, outtab):
     return text.translate(transtab)
 
 
+def file_digest(filename):
+    """sha1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as inf:
+        for chunk in iter(lambda: inf.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_file_atomic(filename, data):
+    """Replace `filename` with `data` in one step.
+
+    Writes to a temporary file in the same directory first,
+    so readers only ever see the old or the complete new file.
+    """
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(prefix='.%s.' % basename, dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as outf:
+            outf.write(data)
+            outf.flush()
+            os.fsync(outf.fileno())
+        os.rename(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
 def chwd(dir):
     """Change working directory."""
     if not os.path.exists(dir):
@@ -165,6 +319,42 @@ def setprocname(name):
         except ImportError:
             return
 
+# held by background threads around changes a forked child must not
+# inherit half done (see fork)
+fork_lock = threading.RLock()
+
+def fork():
+    """os.fork(), while no other thread is logging or holds `fork_lock`
+
+    A forked child only keeps the thread which forked it, locks other
+    threads held at that moment stay locked in the child for good.
+    (Python 2 has no os.register_at_fork to take care of logging's.)
+    """
+    handlers = [ref() for ref in getattr(logging, '_handlerList', ())]
+    handlers = [handler for handler in handlers
+                if handler is not None and handler.lock is not None]
+    with fork_lock:
+        if logging._lock:
+            logging._lock.acquire()
+        for handler in handlers:
+            handler.acquire()
+        pid = None
+        try:
+            pid = os.fork()
+        finally:
+            if pid == 0:
+                # (fresh locks, owned by nobody)
+                for handler in handlers:
+                    handler.createLock()
+                if logging._lock:
+                    logging._lock = threading.RLock()
+            else:
+                for handler in reversed(handlers):
+                    handler.release()
+                if logging._lock:
+                    logging._lock.release()
+    return pid
+
 def daemon_context(settings, **kwargs):
     pidfile = settings.get('PID_FILE', None)
     if pidfile:
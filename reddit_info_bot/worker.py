@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent search worker
+
+A long-lived child process which runs image searches on request,
+so the spiders (and their reactor) are set up only once, and not
+in a fresh fork for every search.
+Jobs are sent over a local socket, results are streamed back.
+
+In 'forkserver' mode the long-lived process does the imports and
+configuration only, and forks a pre-warmed child for every search.
+"""
+from __future__ import absolute_import, unicode_literals
+import os
+import time
+import signal
+import socket
+import logging
+import itertools
+from six.moves import cPickle as pickle
+
+from . import spamfilter, util
+from .channel import FrameReader, ChannelTimeout
+
+logger = logging.getLogger(__name__)
+
+
+class SearchWorker(object):
+    """Parent side handle of a search worker process
+
+    The worker is (re-)started on demand: after it crashed,
+    and when the spamfilter or public suffix lists it was forked
+    with have since been replaced.
+    """
+
+    cancel_timeout = 10 # seconds the forkserver may take to reap a cancelled job
+
+    def __init__(self, settings, mode='worker'):
+        self.settings = settings
+        self.mode = mode
+        self.pid = None
+        self.channel = None
+        self.restarts = 0
+        self._jobs = itertools.count(1)
+        self._forked_with = None
+
+    def _state(self):
+        # what a forked worker inherits, and would have outdated
+        return (spamfilter.LISTS.get('version'), id(util.psl_cached))
+
+    def start(self):
+        parent, child = socket.socketpair()
+        with util.fork_lock: # (no lists swapped in between)
+            state = self._state()
+            pid = util.fork()
+        if pid == 0: # worker process
+            parent.close()
+            status = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_IGN) # (parent stops us)
+                if self.mode == 'forkserver':
+                    # poll keeps no state in the kernel, a reactor installed
+                    # here can be used by every child forked from us
+                    from twisted.internet import pollreactor
+                    pollreactor.install()
+                    from twisted.internet import reactor
+                    reactor.forksafe = True
+                    from .spiders import serve_forked_searches
+                    serve_forked_searches(self.settings, child)
+                else:
+                    from .spiders import serve_search_jobs
+                    serve_search_jobs(self.settings, child)
+            except BaseException:
+                logger.exception('Search worker failed')
+                status = 1
+            finally:
+                os._exit(status)
+
+        child.close()
+        self.pid = pid
+        self.channel = parent
+        self._reader = FrameReader(parent.fileno())
+        self._writer = parent.makefile('wb')
+        self._forked_with = state
+        logger.info('Search %s started (pid %d)' % (self.mode, pid))
+
+    def stop(self):
+        if self.pid is None:
+            return
+        # closing the channel ends the worker's job loop
+        for f in (self._writer, self.channel):
+            try:
+                f.close()
+            except (IOError, OSError, socket.error):
+                pass
+        self._reap(wait=5)
+        self.pid = None
+        self.channel = None
+
+    def _reap(self, wait=0):
+        deadline = time.time() + wait
+        while True:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except OSError: # (not our child anymore)
+                return True
+            if pid:
+                return True
+            if time.time() >= deadline:
+                break
+            time.sleep(0.1)
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        return True
+
+    def alive(self):
+        if self.pid is None:
+            return False
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except OSError:
+            return False
+        return pid == 0
+
+    def ensure_running(self):
+        if self.pid is not None and self._forked_with != self._state():
+            logger.info('Spam filter lists changed, restarting search worker')
+            self.stop()
+        elif self.pid is not None and not self.alive():
+            logger.warning('Search worker (pid %d) died, restarting' % self.pid)
+            self.restarts += 1
+            self.stop()
+        if self.pid is None:
+            self.start()
+
+    def _send(self, *message):
+        pickle.dump(message, self._writer, pickle.HIGHEST_PROTOCOL)
+        self._writer.flush()
+
+    def _read(self, timeout=None):
+        """Next message from the worker (None once it went away)"""
+        return self._reader.read(timeout)
+
+    def search(self, started=None, deadline=None, **spiderargs):
+        """Run a search job, yield the results as they arrive
+
+        Closing the generator early cancels the rest of the search.
+        `deadline` returns the time until which to wait for the next
+        result (or None); a 'timeout' control message is yielded
+        whenever that passes.
+        """
+        self.ensure_running()
+        job_id = next(self._jobs)
+        try:
+            self._send('search', job_id, spiderargs, started or time.time())
+        except (IOError, OSError, socket.error) as e:
+            logger.error('Search worker unreachable: %s' % e)
+            self.stop()
+            return
+
+        child = None # (forkserver child running the job)
+        done = False
+        try:
+            while True:
+                timeout = deadline and deadline()
+                if timeout is not None:
+                    timeout = max(timeout - time.time(), 0)
+                try:
+                    result = self._read(timeout)
+                except ChannelTimeout:
+                    yield {'_control': 'timeout', 'job': job_id}
+                    continue
+                if result is None:
+                    # worker went away mid-job, keep what we have
+                    logger.error('Search worker exited during search job %d' % job_id)
+                    done = True
+                    self.stop()
+                    return
+                if result.pop('_job', job_id) != job_id:
+                    continue # (late result of a cancelled job)
+                control = result.get('_control')
+                if control and result.get('job') != job_id:
+                    continue
+                if control == 'started':
+                    child = result.get('pid')
+                    continue
+                if control == 'end':
+                    done = True
+                    if result.get('status'):
+                        logger.error('Search job %d failed (exit status %d)' % (job_id, result['status']))
+                    return
+                yield result
+        finally:
+            if not done:
+                self.cancel(job_id, child)
+
+    def cancel(self, job_id, child=None):
+        logger.debug('Cancelling search job %d' % job_id)
+        if self.mode != 'forkserver':
+            # its spiders are stopped, left-over results skipped later
+            try:
+                self._send('cancel', job_id)
+            except (IOError, OSError, socket.error):
+                self.stop()
+            return
+
+        def kill(pid):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        if child:
+            kill(child)
+        # (the forkserver is waiting for it to exit, then says so)
+        while True:
+            try:
+                result = self._read(timeout=self.cancel_timeout)
+            except ChannelTimeout:
+                logger.error('Search forkserver not responding, restarting it')
+                self.stop()
+                return
+            if result is None:
+                self.stop()
+                return
+            if result.get('job') != job_id:
+                continue
+            if result.get('_control') == 'started':
+                kill(result['pid'])
+            elif result.get('_control') == 'end':
+                return
+
+
+search_worker = None
+
+def start_search_worker(settings, mode='worker'):
+    global search_worker
+    if search_worker is None:
+        search_worker = SearchWorker(settings, mode)
+        search_worker.start()
+    return search_worker
+
+def stop_search_worker():
+    global search_worker
+    if search_worker is not None:
+        search_worker.stop()
+        search_worker = None